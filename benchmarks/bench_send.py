@@ -0,0 +1,160 @@
+"""发送吞吐量压测：在本机启动 SMTP 测试服务，用真实的队列、调度、限速和发送路径跑一批合成邮件。
+
+    python benchmarks/bench_send.py                       # 默认矩阵，结果 JSON 打印到标准输出
+    python benchmarks/bench_send.py --recipients 100 1000 --attach-kb 0 512 --tls none smtps starttls
+    python benchmarks/bench_send.py --latency 0.005 --error-rate 0.01 --throttle-rate 0.02 -o result.json
+    python benchmarks/bench_send.py --same-content --max-rcpt 50 --sink-max-rcpt 20   # 通知类邮件：多收件人合并发送
+    python benchmarks/bench_send.py --recipients 20000 --attach-kb 0 --render-processes 4  # 多进程渲染个性化邮件
+
+每组参数在独立的子进程中运行，峰值内存 (peak_rss_kb) 互不影响。
+报告字段：msgs_per_sec 为成功送达的收件人数 / 总耗时，p50_ms / p99_ms 为单次 SMTP 事务在发送线程中的耗时，
+stages_ms 为引擎记录的各阶段 (组装、连接、登录、传输、历史记录) 耗时。
+"""
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+def peak_rss_kb():
+    """当前进程的峰值常驻内存 (KB)，平台不支持时返回 None"""
+    try: import resource
+    except ImportError: return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss  # macOS 单位是字节
+
+def percentile(values, p):
+    if not values: return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def run_case(recipients, attach_kb, tls, latency, error_rate, throttle_rate, workers, per_host, timeout,
+             same_content=False, max_rcpt=1, sink_max_rcpt=0, render_processes=0):
+    """在当前进程中跑一组参数，返回结果字典"""
+    from db import Database
+    from engine import MailEngine
+    from smtp_sink import SMTPSink, make_self_signed_cert
+
+    tmp = tempfile.mkdtemp(prefix="autoemail_bench_")
+    cert = key = None
+    if tls != "none": cert, key = make_self_signed_cert(tmp)
+    sink = SMTPSink(latency=latency, error_rate=error_rate, throttle_rate=throttle_rate, max_rcpt=sink_max_rcpt,
+                    tls=tls, certfile=cert, keyfile=key, seed=1).start()
+    db = Database(os.path.join(tmp, "bench.db"))
+    db.init_schema()
+    db.set_config({"max_workers": workers, "per_host_workers": per_host, "max_rcpt_per_message": max_rcpt,
+                   "render_processes": render_processes})
+    sender, server = "bench@example.com", sink.address
+    engine = MailEngine(db)
+
+    attachments = []
+    if attach_kb:
+        path = os.path.join(tmp, f"attachment_{attach_kb}k.bin")
+        with open(path, "wb") as f: f.write(os.urandom(attach_kb * 1024))
+        attachments.append(path)
+
+    # 包一层实例方法记录每次事务在发送线程中的耗时 (SenderPool 在 start() 时取走 handler)
+    durations = []
+    send_mail = engine._send_mail
+    def timed_send(batch):
+        t0 = time.perf_counter()
+        send_mail(batch)
+        if any(d.status in ("已发送", "失败") for d in batch): durations.append(time.perf_counter() - t0)
+    engine._send_mail = timed_send
+    engine.start(load_pending=False)
+
+    people = [{"name": f"收件人{i}", "email": f"user{i}@example.com"} for i in range(recipients)]
+    t0 = time.perf_counter()
+    greeting = "各位老师" if same_content else "{name}"
+    entries = engine.render(people, f"{greeting}，您好", f"尊敬的{greeting}：\n\n这是一封压测邮件。\n" * 20,
+                            sender, "secret", server, attachments, send_at=time.time())
+    engine.enqueue(entries)
+    del entries, people
+    sent = failed = 0
+    deadline = time.monotonic() + timeout
+    while True:
+        idle = not engine.outstanding()
+        for _, snap in engine.take_changes():
+            if snap and snap[2] == "已发送": sent += 1
+            elif snap and snap[2] == "失败": failed += 1
+        if idle or time.monotonic() > deadline: break
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - t0
+    engine.shutdown()
+    sink.shutdown(); sink.server_close()
+    db.close()
+
+    return {
+        "recipients": recipients, "attach_kb": attach_kb, "tls": tls,
+        "latency_ms": latency * 1000, "error_rate": error_rate, "throttle_rate": throttle_rate,
+        "workers": workers, "per_host": per_host,
+        "same_content": same_content, "max_rcpt": max_rcpt, "sink_max_rcpt": sink_max_rcpt,
+        "render_processes": render_processes,
+        "sent": sent, "failed": failed, "unfinished": recipients - sent - failed,
+        "seconds": round(elapsed, 3),
+        "msgs_per_sec": round(sent / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(durations, 50) * 1000, 2) if durations else None,
+        "p99_ms": round(percentile(durations, 99) * 1000, 2) if durations else None,
+        "peak_rss_kb": peak_rss_kb(),
+        "stages_ms": {stage: {"count": n, "avg": round(avg * 1000, 2), "p95": p95 and p95 * 1000}
+                      for stage, (n, avg, p95) in engine.metrics.summary().items()},
+        "sink": dict(sink.stats),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="AutoEmail 发送吞吐量压测")
+    parser.add_argument("--recipients", type=int, nargs="+", default=[100, 1000], help="每批收件人数")
+    parser.add_argument("--attach-kb", type=int, nargs="+", default=[0, 256], help="附件大小 (KB)，0 表示无附件")
+    parser.add_argument("--tls", nargs="+", choices=("none", "smtps", "starttls"), default=["none"], help="连接方式")
+    parser.add_argument("--latency", type=float, default=0.0, help="测试服务每条命令的响应延迟 (秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="收件人被拒收 (550) 的比例")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="收件人被限流 (451) 的比例")
+    parser.add_argument("--workers", type=int, default=8, help="发送线程数 (max_workers)")
+    parser.add_argument("--per-host", type=int, default=3, help="每个主机的并发数 (per_host_workers)")
+    parser.add_argument("--same-content", action="store_true", help="所有收件人的邮件内容相同 (不含 {name} 等占位符)")
+    parser.add_argument("--max-rcpt", type=int, default=1, help="相同内容的邮件每次事务最多合并的收件人数 (max_rcpt_per_message)")
+    parser.add_argument("--sink-max-rcpt", type=int, default=0, help="测试服务每封邮件接受的收件人上限，超出返回 452")
+    parser.add_argument("--render-processes", type=int, default=0, help="渲染进程数 (render_processes)，0 表示在发送线程中渲染")
+    parser.add_argument("--timeout", type=float, default=600, help="每组参数的最长运行秒数")
+    parser.add_argument("-o", "--output", help="结果写入该文件，默认打印到标准输出")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)  # 子进程模式：只跑第一组参数
+    args = parser.parse_args(argv)
+
+    common = dict(latency=args.latency, error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                  workers=args.workers, per_host=args.per_host, timeout=args.timeout,
+                  same_content=args.same_content, max_rcpt=args.max_rcpt, sink_max_rcpt=args.sink_max_rcpt,
+                  render_processes=args.render_processes)
+    if args.single:
+        print(json.dumps(run_case(args.recipients[0], args.attach_kb[0], args.tls[0], **common), ensure_ascii=False))
+        return 0
+
+    results = []
+    for n, kb, tls in itertools.product(args.recipients, args.attach_kb, args.tls):
+        cmd = [sys.executable, os.path.abspath(__file__), "--single", "--recipients", str(n), "--attach-kb", str(kb),
+               "--tls", tls, "--latency", str(args.latency), "--error-rate", str(args.error_rate),
+               "--throttle-rate", str(args.throttle_rate), "--workers", str(args.workers),
+               "--per-host", str(args.per_host), "--timeout", str(args.timeout),
+               "--max-rcpt", str(args.max_rcpt), "--sink-max-rcpt", str(args.sink_max_rcpt),
+               "--render-processes", str(args.render_processes)] + ["--same-content"] * args.same_content
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode:
+            results.append({"recipients": n, "attach_kb": kb, "tls": tls, "error": proc.stderr.strip().splitlines()[-1:]})
+        else:
+            results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+        print(f"{n} 封 / 附件 {kb}KB / {tls}: {results[-1].get('msgs_per_sec', results[-1].get('error'))}", file=sys.stderr)
+
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f: f.write(text + "\n")
+    else: print(text)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""压测用的本地 SMTP 服务：在当前进程的线程里运行，只统计收到的邮件，不投递。
+
+可配置每条命令的响应延迟、按比例拒收 (550) 和限流 (451)、每封邮件的收件人上限 (452)，以及 SMTPS / STARTTLS。
+"""
+import os
+import random
+import socketserver
+import ssl
+import subprocess
+import threading
+import time
+
+class _Handler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+    def _upgrade(self):
+        """STARTTLS：在原连接上完成 TLS 握手后重新建立读写流"""
+        self.request = self.server.ssl_context.wrap_socket(self.request, server_side=True)
+        self.connection = self.request
+        self.rfile = self.request.makefile("rb")
+        self.wfile = self.request.makefile("wb", buffering=0)
+
+    def handle(self):
+        srv = self.server
+        if srv.tls == "smtps":
+            self.request = srv.ssl_context.wrap_socket(self.request, server_side=True)
+            self.rfile = self.request.makefile("rb")
+            self.wfile = self.request.makefile("wb", buffering=0)
+        with srv.lock: srv.stats["connections"] += 1
+        self.reply("220 autoemail-sink")
+        tls_active = srv.tls == "smtps"
+        rcpts = []
+        while True:
+            line = self.rfile.readline()
+            if not line: return
+            cmd = line.decode("utf-8", "replace").strip()
+            verb = cmd[:4].upper()
+            if srv.latency: time.sleep(srv.latency)
+            if verb in ("EHLO", "HELO"):
+                ext = ["autoemail-sink", "AUTH PLAIN LOGIN", "8BITMIME", "PIPELINING"]
+                if srv.tls == "starttls" and not tls_active: ext.append("STARTTLS")
+                self.wfile.write("".join(f"250{'-' if i < len(ext) - 1 else ' '}{e}\r\n" for i, e in enumerate(ext)).encode())
+            elif verb == "STAR":
+                self.reply("220 go ahead"); self._upgrade(); tls_active = True
+            elif verb == "AUTH":
+                with srv.lock: srv.stats["logins"] += 1
+                self.reply("535 authentication failed" if srv.reject_auth else "235 ok")
+            elif verb == "MAIL":
+                rcpts = []; self.reply("250 ok")
+            elif verb == "RCPT":
+                roll = srv.random.random()
+                if srv.max_rcpt and len(rcpts) >= srv.max_rcpt:
+                    self.reply("452 too many recipients")
+                elif roll < srv.error_rate:
+                    with srv.lock: srv.stats["rejected"] += 1
+                    self.reply("550 no such user")
+                elif roll < srv.error_rate + srv.throttle_rate:
+                    with srv.lock: srv.stats["throttled"] += 1
+                    self.reply("451 slow down")
+                else:
+                    rcpts.append(cmd.split(":", 1)[1].strip("<> ")); self.reply("250 ok")
+            elif verb == "DATA":
+                self.reply("354 end with <CRLF>.<CRLF>")
+                size = 0
+                while True:
+                    chunk = self.rfile.readline()
+                    if chunk in (b".\r\n", b""): break
+                    size += len(chunk)
+                with srv.lock:
+                    srv.stats["messages"] += 1
+                    srv.stats["recipients"] += len(rcpts)
+                    srv.stats["bytes"] += size
+                self.reply("250 queued")
+            elif verb in ("NOOP", "RSET"): self.reply("250 ok")
+            elif verb == "QUIT": self.reply("221 bye"); return
+            else: self.reply("502 not implemented")
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """latency：每条命令响应前等待的秒数；error_rate / throttle_rate：RCPT 返回 550 / 451 的比例；
+    max_rcpt：每封邮件最多接受的收件人数 (超出返回 452，0 表示不限)；reject_auth：拒绝所有登录 (535)；
+    tls 为 none / smtps / starttls，后两者需要 certfile 和 keyfile"""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0, throttle_rate=0.0, max_rcpt=0,
+                 reject_auth=False, tls="none", certfile=None, keyfile=None, seed=None):
+        super().__init__((host, port), _Handler)
+        self.latency = latency
+        self.max_rcpt = max_rcpt
+        self.reject_auth = reject_auth
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.tls = tls
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = dict.fromkeys(("connections", "logins", "messages", "recipients", "bytes", "rejected", "throttled"), 0)
+        self.ssl_context = None
+        if tls != "none":
+            self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self.ssl_context.load_cert_chain(certfile, keyfile)
+
+    @property
+    def address(self):
+        """给 AutoEmail 用的服务器设置，例如 smtps://127.0.0.1:50123"""
+        host, port = self.server_address[:2]
+        return f"{'smtps' if self.tls == 'smtps' else 'smtp'}://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+def make_self_signed_cert(directory):
+    """用 openssl 生成自签名证书，返回 (certfile, keyfile)；没有 openssl 时抛出 RuntimeError"""
+    cert, key = os.path.join(directory, "sink.crt"), os.path.join(directory, "sink.key")
+    try:
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                        "-subj", "/CN=127.0.0.1", "-keyout", key, "-out", cert],
+                       check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise RuntimeError(f"无法生成测试证书: {e}")
+    return cert, key
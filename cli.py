@@ -0,0 +1,211 @@
+"""AutoEmail 命令行：不需要图形界面，可在服务器或计划任务中发送邮件。
+
+    python cli.py send --template 邀请函 --query 教授 --at "2026-11-01 09:00"
+    python cli.py send --template 邀请函 --csv 名单.csv --no-wait
+    python cli.py send --template 通知 --query "" --accounts weighted   # 按配额分给所有发件账号
+    python cli.py accounts add b@163.com --smtp smtp.163.com       # 授权码从 AUTOEMAIL_PASSWORD 或提示输入
+    python cli.py quota set --host smtp.163.com --per-minute 60    # 同一 SMTP 服务器上所有账号合计的限额
+    python cli.py run            # 常驻发送 queue 表中的邮件，并接收 send --no-wait 新加入的邮件
+    python cli.py run --metrics-port 9469   # 同时在 http://127.0.0.1:9469/metrics 提供发送指标
+    python cli.py status
+
+发件邮箱、授权码和 SMTP 服务器默认取图形界面保存的配置，授权码也可以用环境变量 AUTOEMAIL_PASSWORD 提供。
+图形界面、run 和 send 可以同时运行，每封邮件只由占用它的进程发送 (send --no-wait 加入的邮件由 run 或图形界面接管)。
+"""
+import argparse
+import datetime
+import getpass
+import os
+import signal
+import sys
+import threading
+import time
+from db import Database
+from engine import MailEngine, AccountRouter, RateLimiter, iter_contact_rows
+
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'email_data.db')
+
+def parse_schedule(args):
+    if args.at:
+        for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+            try: return datetime.datetime.strptime(args.at, fmt).timestamp()
+            except ValueError: pass
+        raise SystemExit(f"无法识别的时间: {args.at} (格式 YYYY-MM-DD HH:MM)")
+    return time.time() + args.delay
+
+def collect_recipients(db, args):
+    """按 --to / --query / --csv 收集收件人，按邮箱去重"""
+    found = {}
+    for s in args.to or ():
+        name, email = (s.split("<", 1)[0].strip(), s.split("<", 1)[1].strip(" >")) if "<" in s else ("", s.strip())
+        found.setdefault(email, {"name": name, "email": email})
+    if args.query is not None:
+        offset, page = 0, 1000
+        while True:
+            rows = db.search_contacts(args.query, "c.name, c.email", limit=page, offset=offset)
+            for name, email in rows: found.setdefault(email, {"name": name or "", "email": email})
+            if len(rows) < page: break
+            offset += page
+    if args.csv:
+        for _, _, rec in iter_contact_rows(args.csv):
+            if rec: found.setdefault(rec[1], {"name": rec[0], "email": rec[1], "title": rec[2], "department": rec[3]})
+    return list(found.values())
+
+def wait_for(engine, ids, stop):
+    """打印每封邮件的结果，直到这些邮件全部发送完 (或失败)；返回失败数"""
+    failed = 0
+    ids = set(ids)
+    while not stop.is_set():
+        done = not engine.outstanding(ids)  # 先判断再取变化，最后一批结果不会漏打印
+        for eid, snap in engine.take_changes():
+            if eid not in ids or snap is None: continue
+            name, email, status, _, error = snap
+            if status == "已发送": print(f"已发送 {name} <{email}>")
+            elif status == "等待中" and error: print(f"重试   {name} <{email}>: {error}", file=sys.stderr)
+            elif status == "失败":
+                failed += 1
+                print(f"失败   {name} <{email}>: {error}", file=sys.stderr)
+        if done: break
+        stop.wait(0.5)
+    return failed
+
+def cmd_send(db, args, stop):
+    if args.template:
+        tmpl = db.get_template(args.template)
+        if not tmpl: raise SystemExit(f"找不到模板: {args.template}")
+        subject, body = tmpl
+    else:
+        if not args.subject or not args.body_file: raise SystemExit("请指定 --template，或同时指定 --subject 和 --body-file")
+        with open(args.body_file, encoding="utf-8") as f: subject, body = args.subject, f.read()
+    sender = args.sender or db.get_config("email")
+    pwd = os.environ.get("AUTOEMAIL_PASSWORD") or db.get_config("pwd")
+    server = args.server or db.get_config("smtp")
+    if not args.accounts and not (sender and pwd and server): raise SystemExit("缺少发件邮箱、授权码或 SMTP 服务器配置")
+    for p in args.attach or ():
+        if not os.path.isfile(p): raise SystemExit(f"附件不存在: {p}")
+    recipients = collect_recipients(db, args)
+    if not recipients: raise SystemExit("没有找到收件人")
+
+    engine = MailEngine(db)
+    try:
+        entries = engine.render(recipients, subject, body, sender, pwd, server, [os.path.abspath(p) for p in args.attach or ()],
+                                send_at=parse_schedule(args), strategy=args.accounts)
+    except ValueError as e: raise SystemExit(str(e))
+    if args.no_wait:
+        engine.queue_store.add_many(entries, claim=False)
+        print(f"已加入队列 {len(entries)} 封，由 run 或图形界面发送")
+        engine.shutdown(); return 0
+    engine.start(load_pending=False)  # 只发送本次加入的邮件，queue 表中其他邮件留给 run/图形界面
+    engine.enqueue(entries)
+    print(f"已加入队列 {len(entries)} 封，计划发送时间 {datetime.datetime.fromtimestamp(entries[0].send_at):%Y-%m-%d %H:%M:%S}")
+    try: failed = wait_for(engine, [d.id for d in entries], stop)
+    finally: engine.shutdown()
+    return 1 if failed else 0
+
+def cmd_run(db, args, stop):
+    engine = MailEngine(db)
+    engine.start()
+    engine.export_metrics(args.metrics_port, args.metrics_file)
+    engine.apply_history_retention()
+    print(f"发送服务已启动，队列中 {engine.outstanding()} 封待发送")
+    try:
+        while not stop.is_set():
+            idle = not engine.outstanding()
+            for eid, snap in engine.take_changes():
+                if snap and snap[2] in ("已发送", "失败"):
+                    print(f"{snap[2]} {snap[0]} <{snap[1]}>" + (f": {snap[4]}" if snap[4] else ""), flush=True)
+            if args.exit_when_idle and idle: break
+            # 接收 send --no-wait 等其他进程加入的邮件
+            engine.adopt(engine.queue_store.load_waiting(exclude=engine.pending_emails))
+            stop.wait(args.poll)
+    finally: engine.shutdown()
+    return 0
+
+def cmd_accounts(db, args, stop):
+    if args.action != "list" and not args.email: raise SystemExit("请指定邮箱")
+    if args.action == "add":
+        if not args.smtp: raise SystemExit("请用 --smtp 指定 SMTP 服务器")
+        pwd = os.environ.get("AUTOEMAIL_PASSWORD") or getpass.getpass(f"{args.email} 的授权码: ")
+        db.save_account(args.email, pwd, args.smtp, args.weight)
+    elif args.action == "remove": db.delete_account(args.email)
+    for a in db.list_accounts():
+        print(f"{a['email']}  {a['smtp']}  权重 {a['weight']}" + ("" if a["enabled"] else "  (已停用)"))
+    return 0
+
+def cmd_quota(db, args, stop):
+    if args.action == "set":
+        if not (args.email or args.host): raise SystemExit("请指定发件邮箱或 --host SMTP 服务器")
+        scope, key = ("host", args.host) if args.host else ("account", args.email)
+        RateLimiter(db).set_quota(scope, key, args.per_minute, args.per_day)  # 都不指定表示取消限额
+    for scope, key, per_minute, per_day in db.query("SELECT scope, key, per_minute, per_day FROM rate_limits ORDER BY scope, key"):
+        if per_minute or per_day:
+            print(f"{'主机' if scope == 'host' else '账号'} {key}  每分钟 {per_minute or '不限'}  每日 {per_day or '不限'}")
+    return 0
+
+def cmd_status(db, args, stop):
+    for state, n, first in db.query("SELECT state, COUNT(*), MIN(send_at) FROM queue GROUP BY state"):
+        when = f"，最早 {datetime.datetime.fromtimestamp(first):%Y-%m-%d %H:%M:%S}" if state == "waiting" and first else ""
+        print(f"{state}: {n}{when}")
+    return 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description="AutoEmail 命令行发送工具")
+    parser.add_argument("--db", default=DB_PATH, help="数据库文件 (默认与程序同目录的 email_data.db)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("send", help="按模板给一批收件人发送邮件")
+    p.add_argument("--template", help="模板名称")
+    p.add_argument("--subject", help="不使用模板时的邮件主题")
+    p.add_argument("--body-file", help="不使用模板时的正文文件 (UTF-8)")
+    p.add_argument("--to", action="append", help='收件人，如 "张三 <zhang@example.com>"，可重复')
+    p.add_argument("--query", help='从通讯录中检索收件人 (与通讯录搜索框相同)，"" 表示全部联系人')
+    p.add_argument("--csv", help="收件人名单文件 (CSV/Excel，表头同联系人导入)")
+    p.add_argument("--attach", action="append", help="附件路径，可重复")
+    p.add_argument("--at", help="计划发送时间 YYYY-MM-DD HH:MM")
+    p.add_argument("--delay", type=float, default=0, help="延迟多少秒后发送 (默认立即)")
+    p.add_argument("--sender", help="发件邮箱 (默认取配置)")
+    p.add_argument("--server", help="SMTP 服务器 (默认取配置)")
+    p.add_argument("--no-wait", action="store_true", help="只写入队列，不在本进程发送")
+    p.add_argument("--accounts", choices=list(AccountRouter.STRATEGIES),
+                   help="把收件人分给 accounts 中的所有发件账号：round_robin 轮询，weighted 按配额，domain 按收件域名")
+    p.set_defaults(func=cmd_send)
+
+    p = sub.add_parser("run", help="常驻发送队列中的邮件")
+    p.add_argument("--exit-when-idle", action="store_true", help="队列发送完后退出")
+    p.add_argument("--poll", type=float, default=5, help="检查新邮件的间隔秒数")
+    p.add_argument("--metrics-port", type=int, help="在 127.0.0.1 的该端口提供 Prometheus 指标 /metrics (默认取配置 metrics_port)")
+    p.add_argument("--metrics-file", help="定期把 Prometheus 指标写入该文件 (默认取配置 metrics_file)")
+    p.set_defaults(func=cmd_run)
+
+    p = sub.add_parser("accounts", help="查看、添加或删除发件账号")
+    p.add_argument("action", nargs="?", choices=("list", "add", "remove"), default="list")
+    p.add_argument("email", nargs="?")
+    p.add_argument("--smtp", help="SMTP 服务器 (add 时必填)")
+    p.add_argument("--weight", type=int, help="分发权重 (weighted 策略下与剩余配额相乘，默认 1)")
+    p.set_defaults(func=cmd_accounts)
+
+    p = sub.add_parser("quota", help="查看或设置发件账号、SMTP 服务器的限额")
+    p.add_argument("action", nargs="?", choices=("list", "set"), default="list")
+    p.add_argument("email", nargs="?", help="发件邮箱")
+    p.add_argument("--host", help="改为设置该 SMTP 服务器 (与账号的 SMTP 设置相同) 的限额，由使用它的所有账号共用，默认不限")
+    p.add_argument("--per-minute", type=int, help="每分钟最多发送的封数，不指定表示不限")
+    p.add_argument("--per-day", type=int, help="每日最多发送的封数，不指定表示不限")
+    p.set_defaults(func=cmd_quota)
+
+    p = sub.add_parser("status", help="查看队列中各状态的邮件数")
+    p.set_defaults(func=cmd_status)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    db = Database(args.db)
+    db.init_schema()
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *a: stop.set())
+    if hasattr(signal, "SIGTERM"): signal.signal(signal.SIGTERM, lambda *a: stop.set())
+    try: return args.func(db, args, stop)
+    finally: db.close()
+
+if __name__ == "__main__":
+    import multiprocessing; multiprocessing.freeze_support()  # 打包后的渲染进程 (render_processes) 需要
+    sys.exit(main())
@@ -0,0 +1,372 @@
+import sqlite3
+import threading
+import contextlib
+import datetime
+import queue
+import time
+
+# ==========================================
+# 数据访问层
+# ==========================================
+
+# 邮箱已存在时更新该联系人；导入文件里为空的职称/院系不覆盖原有数据
+UPSERT_CONTACT_SQL = ("INSERT INTO contacts (name, email, title, department) VALUES (?,?,?,?) "
+                      "ON CONFLICT(email) DO UPDATE SET name=excluded.name, "
+                      "title=COALESCE(NULLIF(excluded.title, ''), title), "
+                      "department=COALESCE(NULLIF(excluded.department, ''), department)")
+
+CONTACT_SEARCH_COLUMNS = ("name", "email", "title", "department")
+
+def _like_pattern(term):
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+HISTORY_INSERT_SQL = "INSERT INTO history (recipient_name, recipient_email, subject, sent_at, status) VALUES (?,?,?,?,?)"
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS contacts (id INTEGER PRIMARY KEY, name TEXT, email TEXT, title TEXT, department TEXT)',
+    'CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY, recipient_name TEXT, recipient_email TEXT, subject TEXT, sent_at TIMESTAMP, status TEXT)',
+    'CREATE TABLE IF NOT EXISTS config (key TEXT UNIQUE, value TEXT)',
+    'CREATE TABLE IF NOT EXISTS templates (id INTEGER PRIMARY KEY, name TEXT, subject TEXT, content TEXT)',
+    'CREATE TABLE IF NOT EXISTS rate_limits (scope TEXT, key TEXT, per_minute INTEGER, per_day INTEGER, PRIMARY KEY (scope, key))',
+    'CREATE TABLE IF NOT EXISTS rate_usage (scope TEXT, key TEXT, day TEXT, sent INTEGER, PRIMARY KEY (scope, key, day))',
+    'CREATE TABLE IF NOT EXISTS queue (id TEXT PRIMARY KEY, name TEXT, email TEXT, subject TEXT, content TEXT, sender TEXT, pwd TEXT, server TEXT, attachments TEXT, send_at REAL, state TEXT, error TEXT, updated_at REAL, attempts INTEGER DEFAULT 0, strategy TEXT, campaign_id TEXT, fields TEXT, owner TEXT, lease_until REAL)',
+    'CREATE TABLE IF NOT EXISTS campaigns (id TEXT PRIMARY KEY, subject TEXT, content TEXT, sender TEXT, pwd TEXT, server TEXT, attachments TEXT, strategy TEXT, fields TEXT, created_at REAL)',
+    'CREATE TABLE IF NOT EXISTS accounts (email TEXT PRIMARY KEY, pwd TEXT, smtp TEXT, weight INTEGER DEFAULT 1, enabled INTEGER DEFAULT 1)',
+    'CREATE INDEX IF NOT EXISTS idx_queue_state ON queue(state)',
+    'CREATE INDEX IF NOT EXISTS idx_history_sent_at ON history(sent_at)',
+    'CREATE INDEX IF NOT EXISTS idx_history_email ON history(recipient_email)',
+    'CREATE INDEX IF NOT EXISTS idx_history_status ON history(status)',
+)
+
+# 失败记录的状态是 "失败: 原因"，用 GLOB 前缀匹配才能走索引 (LIKE 默认不区分大小写，用不上索引)
+HISTORY_STATUS_FILTERS = {"成功": "h.status = '成功'", "失败": "h.status GLOB '失败*'"}
+
+def history_where(since=None, until=None, recipient=None, status=None):
+    """历史记录的筛选条件，返回 (where, params)。since/until 为 YYYY-MM-DD (含当天)，
+    recipient 含 @ 时按邮箱精确匹配，否则按姓名/邮箱包含匹配；status 为 "成功" 或 "失败"。"""
+    where, params = [], []
+    if since:
+        where.append("h.sent_at >= ?"); params.append(since)
+    if until:
+        day = datetime.date.fromisoformat(until) + datetime.timedelta(days=1)
+        where.append("h.sent_at < ?"); params.append(day.isoformat())
+    if recipient:
+        if "@" in recipient:
+            where.append("h.recipient_email = ?"); params.append(recipient)
+        else:
+            where.append("(h.recipient_name LIKE ? ESCAPE '\\' OR h.recipient_email LIKE ? ESCAPE '\\')")
+            params.extend([_like_pattern(recipient)] * 2)
+    if status in HISTORY_STATUS_FILTERS: where.append(HISTORY_STATUS_FILTERS[status])
+    return " AND ".join(where) or "1", params
+
+class Database:
+    """每个线程持有一条长连接 (WAL 模式，读写互不阻塞)，SQL 写成固定字符串以复用已编译的语句。
+    写操作统一走 transaction()，读操作用 query()/query_one()，不会在连接上留下未结束的事务。"""
+    CACHED_STATEMENTS = 256
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",   # WAL 下只在检查点时 fsync，断电最多丢最后几个事务
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-8000",     # 每条连接 8MB 页缓存
+    )
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._conns = []   # [(线程, 连接)]，线程结束后回收它的连接
+        self._lock = threading.Lock()
+        self._contact_columns = None
+        self.has_fts = False
+
+    # ---------- 连接与事务 ----------
+    def conn(self):
+        """当前线程的连接，首次使用时创建"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False,
+                                   cached_statements=self.CACHED_STATEMENTS)
+            for p in self.PRAGMAS: conn.execute(p)
+            self._local.conn = conn
+            with self._lock:
+                dead = [c for t, c in self._conns if not t.is_alive()]
+                self._conns = [(t, c) for t, c in self._conns if t.is_alive()]
+                self._conns.append((threading.current_thread(), conn))
+            for c in dead: c.close()
+        return conn
+
+    def release(self):
+        """关闭当前线程的连接 (短生命周期的后台线程结束前调用)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None: return
+        self._local.conn = None
+        with self._lock: self._conns = [(t, c) for t, c in self._conns if c is not conn]
+        conn.close()
+
+    def close(self):
+        with self._lock: conns, self._conns = self._conns, []
+        for _, c in conns:
+            try: c.close()
+            except sqlite3.Error: pass
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """写事务：一开始就取得写锁 (BEGIN IMMEDIATE)，避免先读后写时与其他线程互相等待；嵌套时并入外层事务"""
+        conn = self.conn()
+        if conn.in_transaction:
+            yield conn; return
+        conn.execute("BEGIN IMMEDIATE")
+        try: yield conn
+        except BaseException:
+            conn.rollback(); raise
+        conn.commit()
+
+    def execute(self, sql, params=()):
+        with self.transaction() as conn: return conn.execute(sql, params).rowcount
+
+    def executemany(self, sql, rows):
+        with self.transaction() as conn: conn.executemany(sql, rows)
+
+    def query(self, sql, params=()):
+        return self.conn().execute(sql, params).fetchall()
+
+    def query_one(self, sql, params=()):
+        return self.conn().execute(sql, params).fetchone()
+
+    def init_schema(self):
+        with self.transaction() as c:
+            for sql in SCHEMA: c.execute(sql)
+            if not c.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_contacts_email'").fetchone():
+                # 建唯一索引前先去掉重复导入的联系人，每个邮箱保留最新的一条
+                c.execute('DELETE FROM contacts WHERE id NOT IN (SELECT MAX(id) FROM contacts GROUP BY email)')
+                c.execute('CREATE UNIQUE INDEX idx_contacts_email ON contacts(email)')
+            # 旧版本数据库的 queue 表没有重试次数、分发策略、群发 (campaigns) 和进程占用相关的列
+            queue_columns = {r[1] for r in c.execute("PRAGMA table_info(queue)")}
+            for col, decl in (("attempts", "INTEGER DEFAULT 0"), ("strategy", "TEXT"), ("campaign_id", "TEXT"), ("fields", "TEXT"),
+                              ("owner", "TEXT"), ("lease_until", "REAL")):
+                if col not in queue_columns: c.execute(f"ALTER TABLE queue ADD COLUMN {col} {decl}")
+            if not c.execute("SELECT 1 FROM accounts LIMIT 1").fetchone():
+                # 旧版本只在 config 中保存一个发件账号，迁移为 accounts 表的第一个账号
+                cfg = dict(c.execute("SELECT key, value FROM config WHERE key IN ('email', 'pwd', 'smtp')"))
+                if cfg.get("email"): c.execute("INSERT INTO accounts (email, pwd, smtp) VALUES (?,?,?)",
+                                               (cfg["email"], cfg.get("pwd"), cfg.get("smtp")))
+            self.has_fts = self._ensure_contact_search_index(c)
+        self._contact_columns = None
+
+    # ---------- 配置 ----------
+    def get_config(self, key, default=None):
+        r = self.query_one("SELECT value FROM config WHERE key=?", (key,))
+        return r[0] if r and r[0] not in (None, "") else default
+
+    def all_config(self):
+        return dict(self.query("SELECT key, value FROM config"))
+
+    def set_config(self, items):
+        """写入若干配置项 {key: value}，其他配置项保持不变"""
+        self.executemany("INSERT OR REPLACE INTO config (key, value) VALUES (?,?)", list(items.items()))
+
+    # ---------- 发件账号 ----------
+    def list_accounts(self, enabled_only=False):
+        rows = self.query("SELECT email, pwd, smtp, weight, enabled FROM accounts" + (" WHERE enabled=1" if enabled_only else "") + " ORDER BY rowid")
+        return [dict(zip(("email", "pwd", "smtp", "weight", "enabled"), r)) for r in rows]
+
+    def save_account(self, email, pwd, smtp, weight=None, enabled=None):
+        """新增或更新发件账号；weight/enabled 为 None 时保留原值 (新账号为 1)"""
+        self.execute("INSERT INTO accounts (email, pwd, smtp, weight, enabled) VALUES (?,?,?,COALESCE(?,1),COALESCE(?,1)) "
+                     "ON CONFLICT(email) DO UPDATE SET pwd=excluded.pwd, smtp=excluded.smtp, "
+                     "weight=COALESCE(?, weight), enabled=COALESCE(?, enabled)",
+                     (email, pwd, smtp, weight, enabled, weight, enabled))
+
+    def delete_account(self, email):
+        self.execute("DELETE FROM accounts WHERE email=?", (email,))
+
+    # ---------- 模板 ----------
+    def list_templates(self):
+        return self.query("SELECT id, name, subject FROM templates")
+
+    def template_names(self):
+        return [r[0] for r in self.query("SELECT name FROM templates")]
+
+    def get_template(self, name):
+        """按名称取模板，返回 (主题, 正文) 或 None"""
+        return self.query_one("SELECT subject, content FROM templates WHERE name=?", (name,))
+
+    def add_template(self, name, subject, content):
+        self.execute("INSERT INTO templates (name, subject, content) VALUES (?,?,?)", (name, subject, content))
+
+    def delete_template(self, tid):
+        self.execute("DELETE FROM templates WHERE id=?", (tid,))
+
+    # ---------- 历史记录 ----------
+    def log_history(self, name, email, subject, status, sent_at=None):
+        self.execute(HISTORY_INSERT_SQL, (name, email, subject, sent_at or datetime.datetime.now(), status))
+
+    def log_history_many(self, rows):
+        """rows 为 (姓名, 邮箱, 主题, 发送时间, 状态)"""
+        self.executemany(HISTORY_INSERT_SQL, rows)
+
+    def clear_history(self):
+        self.execute("DELETE FROM history")
+
+    def archive_history(self, before, archive_path, chunk_size=5000):
+        """把 sent_at 早于 before 的记录移到归档库 (附加为 archive 的独立数据库文件)，返回移动的条数。
+        按 id 分块搬运，每块一个事务，不会长时间占住写锁。"""
+        conn = self.conn()
+        conn.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+        moved = 0
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS archive.history (id INTEGER PRIMARY KEY, recipient_name TEXT, recipient_email TEXT, subject TEXT, sent_at TIMESTAMP, status TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_history_sent_at ON history(sent_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_history_email ON history(recipient_email)")
+            while True:
+                with self.transaction():
+                    ids = [r[0] for r in conn.execute("SELECT id FROM main.history WHERE sent_at < ? ORDER BY sent_at LIMIT ?", (before, chunk_size))]
+                    if not ids: break
+                    marks = ",".join("?" * len(ids))
+                    # 归档库里 id 可能已被占用 (例如清空过历史后 id 重新从 1 开始)，由归档库重新分配
+                    conn.execute(f"INSERT INTO archive.history (recipient_name, recipient_email, subject, sent_at, status) "
+                                 f"SELECT recipient_name, recipient_email, subject, sent_at, status FROM main.history WHERE id IN ({marks}) ORDER BY id", ids)
+                    conn.execute(f"DELETE FROM main.history WHERE id IN ({marks})", ids)
+                moved += len(ids)
+        finally:
+            conn.execute("DETACH DATABASE archive")
+        return moved
+
+    # ---------- 联系人 ----------
+    def contact_columns(self):
+        if self._contact_columns is None:
+            self._contact_columns = [r[1] for r in self.query("PRAGMA table_info(contacts)")]
+        return self._contact_columns
+
+    def fetch_contacts_by_email(self, emails, factory=dict):
+        """一次查询取出所有收件人的联系人记录，返回 {email: factory(非空字段)}"""
+        conn = self.conn()
+        with conn:  # 临时表的写入也会开启事务，查完立即提交，不长期占用读快照
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_emails (email TEXT PRIMARY KEY)")
+            conn.execute("DELETE FROM lookup_emails")
+            conn.executemany("INSERT OR IGNORE INTO lookup_emails VALUES (?)", ((e,) for e in emails))
+            cur = conn.execute("SELECT c.* FROM contacts c JOIN lookup_emails l ON c.email = l.email")
+            cols = [d[0] for d in cur.description]
+            idx = cols.index("email")
+            found = {}
+            for row in cur:
+                found[row[idx]] = factory((k, v) for k, v in zip(cols, row) if v is not None)
+            conn.execute("DELETE FROM lookup_emails")
+        return found
+
+    def upsert_contacts(self, rows):
+        """rows 为 (姓名, 邮箱, 职称, 院系)；在外层事务中调用时并入该事务"""
+        self.executemany(UPSERT_CONTACT_SQL, rows)
+
+    def delete_contacts(self, ids):
+        self.executemany("DELETE FROM contacts WHERE id=?", [(i,) for i in ids])
+
+    def _ensure_contact_search_index(self, conn):
+        """建立 contacts_fts (FTS5 trigram 分词，中文可按任意 3 字以上片段检索) 并用触发器与 contacts 表同步。
+        SQLite 不支持 FTS5/trigram 时返回 False，搜索退回 LIKE 扫描。"""
+        cols = ", ".join(CONTACT_SEARCH_COLUMNS)
+        new_cols = ", ".join("new." + c for c in CONTACT_SEARCH_COLUMNS)
+        old_cols = ", ".join("old." + c for c in CONTACT_SEARCH_COLUMNS)
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE name='contacts_fts'").fetchone():
+            try:
+                conn.execute(f"CREATE VIRTUAL TABLE contacts_fts USING fts5({cols}, content='contacts', content_rowid='id', tokenize='trigram')")
+            except sqlite3.OperationalError:
+                return False
+            conn.execute("INSERT INTO contacts_fts(contacts_fts) VALUES ('rebuild')")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS contacts_fts_ai AFTER INSERT ON contacts BEGIN "
+                     f"INSERT INTO contacts_fts(rowid, {cols}) VALUES (new.id, {new_cols}); END")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS contacts_fts_ad AFTER DELETE ON contacts BEGIN "
+                     f"INSERT INTO contacts_fts(contacts_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols}); END")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS contacts_fts_au AFTER UPDATE ON contacts BEGIN "
+                     f"INSERT INTO contacts_fts(contacts_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols}); "
+                     f"INSERT INTO contacts_fts(rowid, {cols}) VALUES (new.id, {new_cols}); END")
+        return True
+
+    def search_contacts(self, query, fields="c.id, c.name, c.email, c.title, c.department", limit=200, offset=0):
+        """按空格分词检索姓名/邮箱/职称/院系，结果按相关度排序并分页。
+        不少于 3 个字的词走 FTS 索引；更短的词 (如两个字的中文姓名) 只能用 LIKE 过滤。"""
+        terms = query.split()
+        if not terms:
+            return self.query(f"SELECT {fields} FROM contacts c ORDER BY c.id LIMIT ? OFFSET ?", (limit, offset))
+        indexed = [t for t in terms if len(t) >= 3] if self.has_fts else []
+        where, params = [], []
+        for t in terms:
+            if t in indexed: continue
+            where.append("(" + " OR ".join(f"c.{col} LIKE ? ESCAPE '\\'" for col in CONTACT_SEARCH_COLUMNS) + ")")
+            params.extend([_like_pattern(t)] * len(CONTACT_SEARCH_COLUMNS))
+        if indexed:
+            match = " AND ".join('"' + t.replace('"', '""') + '"' for t in indexed)
+            sql = (f"SELECT {fields} FROM contacts_fts JOIN contacts c ON c.id = contacts_fts.rowid "
+                   f"WHERE contacts_fts MATCH ? {''.join(' AND ' + w for w in where)} ORDER BY contacts_fts.rank LIMIT ? OFFSET ?")
+            params.insert(0, match)
+        else:
+            # 姓名以关键词开头的排在前面
+            sql = (f"SELECT {fields} FROM contacts c WHERE {' AND '.join(where)} "
+                   f"ORDER BY CASE WHEN c.name LIKE ? ESCAPE '\\' THEN 0 ELSE 1 END, c.id LIMIT ? OFFSET ?")
+            params.append(_like_pattern(terms[0])[1:])
+        return self.query(sql, params + [limit, offset])
+
+# ==========================================
+# 后台批量写入
+# ==========================================
+
+class BatchWriter:
+    """写后台 (write-behind)：调用方只把记录放进内存队列，由专门的线程攒够 batch_size 条或等满 interval 秒后
+    一次事务写入。队列最多积压 max_backlog 条，写满时 put 会阻塞调用方 (背压)，避免磁盘过慢时内存无限增长。"""
+    RETRIES = 3
+
+    def __init__(self, write_many, batch_size=200, interval=0.5, max_backlog=10000, name="BatchWriter"):
+        self.write_many = write_many
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.Queue(max_backlog)
+        self._closed = False
+        self._lock = threading.Lock()  # put 与 close 互斥，关闭后不会有记录排在停止标记之后
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def put(self, row):
+        """放入一条记录；关闭后 (程序退出时仍在收尾的发送线程) 直接同步写入，不丢记录"""
+        with self._lock:
+            if not self._closed: return self._queue.put(row)
+        self._write([row])
+
+    def flush(self):
+        """阻塞到此前放入的记录全部写入"""
+        self._queue.join()
+
+    def close(self, timeout=10):
+        """写完剩余记录后停止后台线程 (程序退出时调用)"""
+        with self._lock:
+            if self._closed: return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            batch, taken = [], 1
+            if item is None: stop = True
+            else: batch.append(item)
+            deadline = time.monotonic() + self.interval
+            while not stop and len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: break
+                try: item = self._queue.get(timeout=remaining)
+                except queue.Empty: break
+                taken += 1
+                if item is None: stop = True
+                else: batch.append(item)
+            if batch: self._write(batch)
+            for _ in range(taken): self._queue.task_done()
+
+    def _write(self, batch):
+        for attempt in range(self.RETRIES):
+            try: return self.write_many(batch)
+            except Exception as e:
+                print(f"批量写入失败 (第 {attempt + 1} 次): {e}")
+                time.sleep(self.interval * (attempt + 1))
+        print(f"放弃写入 {len(batch)} 条记录")
@@ -0,0 +1,1535 @@
+import smtplib
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from email.mime.base import MIMEBase
+from email.generator import BytesGenerator
+import os
+import threading
+import time
+import datetime
+import collections
+import json
+import heapq
+import itertools
+import base64
+import tempfile
+import shutil
+import io
+import re
+import uuid
+import csv
+import codecs
+import importlib.util
+import random
+import socket
+import zlib
+import bisect
+import contextlib
+import weakref
+from db import BatchWriter
+
+# openpyxl 导入较慢，这里只检查是否安装，真正读取 Excel 时才导入
+EXCEL_SUPPORT = importlib.util.find_spec("openpyxl") is not None
+
+# ==========================================
+# 发送指标
+# ==========================================
+
+class Metrics:
+    """发送过程的计数器和各阶段耗时直方图 (线程安全)，可导出为 Prometheus 文本格式"""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # 秒
+    STAGES = {"mime": "组装", "connect": "连接", "auth": "登录", "data": "传输", "history": "记录"}
+    COUNTERS = {"sent": "成功发送的邮件数", "failed": "最终失败、进入死信的邮件数 (按 SMTP 响应码)",
+                "retries": "重试次数 (throttle 为限流，transient 为其他临时错误，reconnect 为会话断开后重连，failover 为改派给其他账号)",
+                "deferred": "因本地限速重新排队的次数"}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()  # (名称, 标签元组) -> 值
+        self._hist = {}                         # 阶段 -> [各桶计数..., +Inf 桶计数, 耗时总和]
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock: self._counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            h = self._hist.get(stage)
+            if h is None: h = self._hist[stage] = [0] * (len(self.BUCKETS) + 2)
+            h[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            h[-1] += seconds
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        """记录 with 块的耗时，异常退出时同样记录"""
+        t0 = time.perf_counter()
+        try: yield
+        finally: self.observe(stage, time.perf_counter() - t0)
+
+    def total(self, name):
+        with self._lock: return sum(v for (n, _), v in self._counters.items() if n == name)
+
+    def by_label(self, name, label):
+        """按某个标签汇总计数器，返回 Counter {标签值: 计数}"""
+        result = collections.Counter()
+        with self._lock:
+            for (n, labels), v in self._counters.items():
+                if n == name: result[dict(labels).get(label)] += v
+        return result
+
+    def summary(self):
+        """给界面用的摘要：{阶段: (次数, 平均秒数, p95 秒数)}，p95 取所在桶的上界 (超出最大桶时为 None)"""
+        with self._lock: hist = {k: list(v) for k, v in self._hist.items()}
+        result = {}
+        for stage, h in hist.items():
+            count = sum(h[:-1])
+            if not count: continue
+            acc, p95 = 0, None
+            for bound, n in zip(self.BUCKETS, h):
+                acc += n
+                if acc >= count * 0.95: p95 = bound; break
+            result[stage] = (count, h[-1] / count, p95)
+        return result
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def prometheus_text(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            hist = sorted((k, list(v)) for k, v in self._hist.items())
+        lines = []
+        for name, help_text in self.COUNTERS.items():
+            lines += [f"# HELP autoemail_{name}_total {help_text}", f"# TYPE autoemail_{name}_total counter"]
+            samples = [(labels, v) for (n, labels), v in counters if n == name] or [((), 0)]
+            for labels, v in samples:
+                label_text = ",".join(f'{k}="{self._escape(val)}"' for k, val in labels)
+                lines.append(f"autoemail_{name}_total{{{label_text}}} {v}" if label_text else f"autoemail_{name}_total {v}")
+        lines += ["# HELP autoemail_stage_seconds 单封邮件各阶段耗时 (history 为每批历史记录的写入耗时)",
+                  "# TYPE autoemail_stage_seconds histogram"]
+        for stage, h in hist:
+            acc = 0
+            for bound, n in zip(self.BUCKETS + ("+Inf",), h):
+                acc += n
+                lines.append(f'autoemail_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {acc}')
+            lines.append(f'autoemail_stage_seconds_sum{{stage="{stage}"}} {h[-1]:.6f}')
+            lines.append(f'autoemail_stage_seconds_count{{stage="{stage}"}} {acc}')
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, path):
+        """写入 Prometheus 文本文件 (可供 node_exporter 的 textfile 收集器读取)；先写临时文件再替换，读取方不会读到半个文件"""
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f: f.write(self.prometheus_text())
+        os.replace(tmp, path)
+
+    def serve(self, port, host="127.0.0.1"):
+        """在后台线程提供 http://host:port/metrics，返回 HTTP 服务器对象 (调用 shutdown() 停止)"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args): pass
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="MetricsHTTP", daemon=True).start()
+        return server
+
+# ==========================================
+# SMTP 连接池
+# ==========================================
+
+def parse_server(server):
+    """解析 SMTP 服务器设置，返回 (主机, 端口, 连接方式)，连接方式为 ssl / starttls / plain。
+    支持 "主机"、"主机:端口" 和 "smtps://主机:端口" / "smtp://主机:端口" 的写法：
+    只写主机时 QQ 邮箱和其他服务商走 465 SSL，Office365 走 587 STARTTLS；
+    465 端口为 SSL，其他端口必须 STARTTLS (服务器不支持时不登录，避免明文发送授权码)；
+    只有明确写成 smtp:// 时才允许明文连接，服务器支持时仍会升级 STARTTLS。"""
+    scheme, _, rest = server.rpartition("://")
+    host, sep, port = rest.rpartition(":")
+    if not sep or not port.isdigit(): host, port = rest, ""
+    if scheme == "smtps": return host, int(port or 465), "ssl"
+    if scheme == "smtp": return host, int(port or 25), "plain"
+    if port:
+        port = int(port)
+        return host, port, "ssl" if port == 465 else "starttls"
+    if "office365" in host: return host, 587, "starttls"
+    return host, 465, "ssl"
+
+class PooledSMTP:
+    """连接池中的一个已登录会话"""
+    __slots__ = ("key", "smtp", "sent", "last_used")
+
+    def __init__(self, key, smtp):
+        self.key = key
+        self.smtp = smtp
+        self.sent = 0
+        self.last_used = time.time()
+
+class SMTPConnectionPool:
+    """按 (服务器, 发件人, 授权码) 复用已登录的 SMTP 会话，避免每封邮件都握手+登录"""
+    def __init__(self, max_messages=100, idle_timeout=60, check_after=5, timeout=30, metrics=None):
+        self.metrics = metrics or Metrics()
+        self.max_messages = max_messages  # 单个会话最多发送的邮件数，超过后重新建立连接
+        self.idle_timeout = idle_timeout  # 空闲超过该秒数的会话会被关闭
+        self.check_after = check_after    # 空闲超过该秒数的会话在复用前先发 NOOP 检查
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._reaper, daemon=True).start()
+
+    def _connect(self, server):
+        host, port, mode = parse_server(server)
+        if not host: raise ValueError("未设置 SMTP 服务器")
+        s = (smtplib.SMTP_SSL if mode == "ssl" else smtplib.SMTP)(host, port, timeout=self.timeout)
+        # 命令都是一问一答，邮件内容也是整块写出，关闭 Nagle 算法：否则附件后面的小块要等对方的延迟确认，每封多约 40ms
+        s.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if mode == "ssl": return s
+        s.ehlo_or_helo_if_needed()
+        if not s.has_extn("starttls"):
+            if mode == "plain": return s
+            s.close()
+            raise smtplib.SMTPNotSupportedError(f"{host}:{port} 不支持 STARTTLS，为避免明文发送授权码未登录；确需明文连接请写成 smtp://{host}:{port}")
+        s.starttls()
+        return s
+
+    @staticmethod
+    def _close(smtp):
+        try: smtp.quit()
+        except Exception:
+            try: smtp.close()
+            except Exception: pass
+
+    def _healthy(self, conn):
+        if time.time() - conn.last_used < self.check_after: return True
+        try: return conn.smtp.noop()[0] == 250
+        except Exception: return False
+
+    def acquire(self, server, sender, pwd):
+        """取出一个可用会话，没有则新建并登录；返回 (会话, 是否为复用会话)"""
+        key = (server, sender, pwd)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                conn = idle.pop() if idle else None
+            if conn is None: break
+            if self._healthy(conn): return conn, True
+            self._close(conn.smtp)
+        with self.metrics.span("connect"): smtp = self._connect(server)
+        try:
+            with self.metrics.span("auth"): smtp.login(sender, pwd)
+        except Exception:
+            self._close(smtp); raise
+        return PooledSMTP(key, smtp), False
+
+    def release(self, conn):
+        conn.sent += 1
+        conn.last_used = time.time()
+        if conn.sent >= self.max_messages: return self._close(conn.smtp)
+        with self._lock: self._idle.setdefault(conn.key, []).append(conn)
+
+    def discard(self, conn):
+        self._close(conn.smtp)
+
+    def sendmail(self, server, sender, pwd, to_addrs, msg):
+        return self.transact(server, sender, pwd, lambda smtp: smtp.sendmail(sender, to_addrs, msg))
+
+    def send_stream(self, server, sender, pwd, to_addrs, message):
+        """DATA 阶段边生成边写入 socket，message 需提供可重复调用、产出已做点填充内容的 chunks()"""
+        return self.transact(server, sender, pwd, lambda smtp: stream_data(smtp, sender, to_addrs, message.chunks(), stuffed=True))
+
+    def transact(self, server, sender, pwd, fn):
+        """用池中会话执行一次邮件事务；复用的会话若已被服务器断开，则重新连接后重试一次"""
+        while True:
+            conn, reused = self.acquire(server, sender, pwd)
+            try:
+                with self.metrics.span("data"): result = fn(conn.smtp)
+            except smtplib.SMTPServerDisconnected:
+                self.discard(conn)
+                if reused:
+                    self.metrics.inc("retries", reason="reconnect"); continue
+                raise
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                # 服务器拒收但会话仍然可用 (smtplib 已发送 RSET)；421 表示服务器已关闭会话
+                if smtp_error_code(e) == 421: self.discard(conn)
+                else: self.release(conn)
+                raise
+            except Exception:
+                self.discard(conn); raise
+            self.release(conn)
+            return result
+
+    def close_idle(self, max_idle=None):
+        max_idle = self.idle_timeout if max_idle is None else max_idle
+        now = time.time(); expired = []
+        with self._lock:
+            for key, conns in list(self._idle.items()):
+                keep = [c for c in conns if now - c.last_used < max_idle]
+                expired.extend(c for c in conns if now - c.last_used >= max_idle)
+                if keep: self._idle[key] = keep
+                else: del self._idle[key]
+        for c in expired: self._close(c.smtp)
+
+    def close_all(self):
+        self.close_idle(max_idle=0)
+
+    def _reaper(self):
+        while True:
+            time.sleep(max(1, self.idle_timeout / 2))
+            self.close_idle()
+
+_LEADING_DOT = re.compile(rb'(?m)^\.')
+
+def _reset_or_close(smtp, code):
+    if code == 421: return smtp.close()
+    try: smtp.rset()
+    except smtplib.SMTPServerDisconnected: pass
+
+def stream_data(smtp, sender, to_addrs, chunks, stuffed=False):
+    """与 smtplib.SMTP.sendmail 相同的事务流程，但邮件内容按块直接写入 socket。
+    chunks 中每一块都必须由完整的 CRLF 行组成；stuffed 为 True 表示已经做过点填充。返回被拒收的收件人字典。"""
+    smtp.ehlo_or_helo_if_needed()
+    code, resp = smtp.mail(sender)
+    if code != 250:
+        _reset_or_close(smtp, code)
+        raise smtplib.SMTPSenderRefused(code, resp, sender)
+    refused = {}
+    for addr in to_addrs:
+        code, resp = smtp.rcpt(addr)
+        if code == 421:
+            # 服务器在 DATA 之前关闭了会话，整封邮件都没有发出，不能只按已拒收的收件人处理
+            smtp.close()
+            raise smtplib.SMTPResponseException(code, resp)
+        if code not in (250, 251): refused[addr] = (code, resp)
+    if len(refused) == len(to_addrs):
+        _reset_or_close(smtp, 0)
+        raise smtplib.SMTPRecipientsRefused(refused)
+    smtp.putcmd("data")
+    code, resp = smtp.getreply()
+    if code != 354:
+        _reset_or_close(smtp, code)
+        raise smtplib.SMTPDataError(code, resp)
+    # 结束符和最后一块一起写出：单独发送 3 字节的 ".\r\n" 会碰上 Nagle 算法与延迟确认，每封邮件多等约 40ms
+    last = b""
+    for chunk in chunks:
+        if not chunk: continue
+        if last: smtp.send(last)
+        last = chunk if stuffed else _LEADING_DOT.sub(b'..', chunk)
+    smtp.send(last + b".\r\n")
+    code, resp = smtp.getreply()
+    if code != 250:
+        _reset_or_close(smtp, code)
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+# ==========================================
+# 并发发送池
+# ==========================================
+
+class SenderPool:
+    """多线程发送池：全局线程数上限 + 每个 SMTP 主机的并发上限，多个主机之间轮转取任务"""
+    def __init__(self, handler, max_workers=8, per_host=3):
+        self.handler = handler
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self._jobs = {}     # host -> deque，dict 的插入顺序即轮转顺序
+        self._active = collections.Counter()
+        self._cond = threading.Condition()
+        for _ in range(max_workers):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, host, job):
+        with self._cond:
+            self._jobs.setdefault(host, collections.deque()).append(job)
+            self._cond.notify()
+
+    def _take(self):
+        for host in list(self._jobs):
+            if self._active[host] >= self.per_host: continue
+            jobs = self._jobs.pop(host)
+            job = jobs.popleft()
+            if jobs: self._jobs[host] = jobs  # 重新插入到末尾，下次优先其他主机
+            self._active[host] += 1
+            return host, job
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                picked = self._take()
+                while picked is None:
+                    self._cond.wait()
+                    picked = self._take()
+            host, job = picked
+            try: self.handler(job)
+            except Exception as e: print(f"发送线程异常: {e}")
+            finally:
+                with self._cond:
+                    self._active[host] -= 1
+                    self._cond.notify_all()
+
+# ==========================================
+# 自适应限速
+# ==========================================
+
+THROTTLE_CODES = (421, 450, 451, 452)  # 服务商限流/临时拒绝时返回的响应码
+
+def smtp_error_code(exc):
+    """从 smtplib 异常中取出 SMTP 响应码，取不到时返回 None"""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in exc.recipients.values()]
+        return min(codes) if codes else None
+    return getattr(exc, "smtp_code", None)
+
+def describe_refusals(refused):
+    """把 smtplib 返回的 {地址: (响应码, 响应)} 转为 {地址: (响应码, 错误说明, 异常)}，异常一项为 None"""
+    return {addr: (code, f"{code} {resp.decode(errors='replace') if isinstance(resp, bytes) else resp}", None)
+            for addr, (code, resp) in refused.items()}
+
+def seconds_until_tomorrow():
+    now = datetime.datetime.now()
+    tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+    return (tomorrow - now).total_seconds()
+
+class TokenBucket:
+    """令牌桶，rate 为每秒补充的令牌数"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def wait_time(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+class AdaptiveLimit:
+    """单个发件账号或 SMTP 主机的限速状态：遇到限流减半速率，连续成功后缓慢恢复。
+    per_minute 为空表示不限速：第一次被限流时按最近一分钟实际速率的一半开始限速，恢复到该速率后再取消限速。"""
+    def __init__(self, per_minute, per_day):
+        self.unlimited = not per_minute
+        self.max_rate = None if self.unlimited else per_minute / 60
+        self.min_rate = RateLimiter.MIN_PER_MINUTE / 60 if self.unlimited else min(self.max_rate, RateLimiter.MIN_PER_MINUTE / 60)
+        self.bucket = None if self.unlimited else TokenBucket(self.max_rate, capacity=max(1, per_minute // 6))
+        self.window = (time.monotonic(), 0)  # (开始时间, 发送数)，估计不限速时的实际速率
+        self.per_day = per_day
+        self.day = datetime.date.today().isoformat()
+        self.sent_today = 0   # 今天所有进程合计的用量 (定期从 rate_usage 读回)
+        self.unflushed = 0    # 本进程新增、还没累加到 rate_usage 的用量
+        self.blocked_until = 0
+        self.streak = 0
+        self.strikes = 0
+
+    def wait_time(self, now):
+        today = datetime.date.today().isoformat()
+        if today != self.day: self.day, self.sent_today, self.unflushed = today, 0, 0
+        if self.per_day and self.sent_today >= self.per_day: return seconds_until_tomorrow()
+        return max(0, self.blocked_until - now, self.bucket.wait_time(now) if self.bucket else 0)
+
+    def take(self, now, count):
+        if self.bucket: self.bucket.tokens -= count
+        self.sent_today += count
+        self.unflushed += count
+        start, sent = self.window
+        self.window = (now, count) if now - start > 60 else (start, sent + count)
+
+    def throttled(self, now):
+        self.streak = 0
+        self.strikes += 1
+        if self.bucket is None:
+            start, sent = self.window
+            self.max_rate = max(self.min_rate, sent / max(1, now - start))
+            self.bucket = TokenBucket(self.max_rate, capacity=max(1, int(self.max_rate * 10)))
+        self.bucket.rate = max(self.min_rate, self.bucket.rate / 2)
+        self.bucket.tokens = 0
+        self.blocked_until = now + min(300, 15 * 2 ** (self.strikes - 1))
+        return self.blocked_until - now
+
+    def succeeded(self):
+        self.streak += 1
+        if self.streak >= RateLimiter.RECOVER_AFTER:
+            self.streak = 0
+            self.strikes = max(0, self.strikes - 1)
+            if not self.bucket: return
+            self.bucket.rate = min(self.max_rate, self.bucket.rate + self.max_rate / 10)
+            if self.unlimited and self.bucket.rate >= self.max_rate and not self.strikes: self.bucket = self.max_rate = None
+
+class RateLimiter:
+    """按发件账号和 SMTP 主机分别限速，配额保存在 rate_limits 表，每日用量保存在 rate_usage 表。
+    图形界面和命令行可能同时运行，每个进程只把自己新增的用量累加到 rate_usage，再读回合计值。"""
+    UNLIMITED_DAILY = 10 ** 6  # 按配额分配账号时，没有设置任何配额的账号视为每天可发的数量
+    MIN_PER_MINUTE = 2
+    RECOVER_AFTER = 20   # 连续成功多少封后提高一档速率
+    MAX_SLEEP = 1.0      # 等待时间超过该秒数时不占用发送线程，改为重新排队
+
+    def __init__(self, db):
+        self.db = db
+        self._limits = {}
+        self._quotas = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        self.flush()  # 先写入本进程的用量，重建限速状态后读回的就是合计值
+        quotas = {(r[0], r[1]): (r[2], r[3]) for r in self.db.query("SELECT scope, key, per_minute, per_day FROM rate_limits")}
+        usage = dict(((r[0], r[1]), r[2]) for r in self.db.query(
+            "SELECT scope, key, sent FROM rate_usage WHERE day=?", (datetime.date.today().isoformat(),)))
+        with self._lock:
+            self._quotas = quotas
+            self._limits = {}
+            for k, sent in usage.items(): self._limit(*k).sent_today = sent
+
+    def _limit(self, scope, key):
+        lim = self._limits.get((scope, key))
+        if lim is None:
+            per_minute, per_day = self._quotas.get((scope, key), (None, None))
+            lim = self._limits[(scope, key)] = AdaptiveLimit(per_minute, per_day or 0)
+        return lim
+
+    def acquire(self, account, host, count=1):
+        """取得一次发送许可 (count 为本次事务的收件人数)；返回 0 表示可以立即发送，否则返回建议的重新排队秒数。
+        只要有一个令牌就放行，多出的收件人记为欠账，由之后的等待补回。"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                limits = (self._limit("account", account), self._limit("host", host))
+                wait = max(lim.wait_time(now) for lim in limits)
+                if wait <= 0:
+                    for lim in limits: lim.take(now, count)
+                    break
+            if wait > self.MAX_SLEEP: return wait
+            time.sleep(wait)
+        if now - self._last_flush > 5:
+            try: self.flush()
+            except Exception as e: print(f"保存发送用量失败: {e}")  # 增量已放回，下次再写
+        return 0
+
+    def on_success(self, account, host):
+        with self._lock:
+            self._limit("account", account).succeeded()
+            self._limit("host", host).succeeded()
+
+    def on_throttle(self, account, host):
+        """服务器返回限流响应码时调用，返回建议的重新排队秒数"""
+        with self._lock:
+            now = time.monotonic()
+            return max(self._limit("account", account).throttled(now), self._limit("host", host).throttled(now))
+
+    def flush(self):
+        """把本进程新增的用量累加到 rate_usage，再读回所有进程今天的合计用量"""
+        with self._lock:
+            rows = [(scope, key, lim.day, lim.unflushed) for (scope, key), lim in self._limits.items() if lim.unflushed]
+            for lim in self._limits.values(): lim.unflushed = 0
+            self._last_flush = time.monotonic()
+        try:
+            if rows: self.db.executemany("INSERT INTO rate_usage (scope, key, day, sent) VALUES (?,?,?,?) "
+                                         "ON CONFLICT(scope, key, day) DO UPDATE SET sent = sent + excluded.sent", rows)
+        except Exception:
+            with self._lock:  # 写入失败：把增量放回，下次再写
+                for scope, key, day, n in rows:
+                    lim = self._limit(scope, key)
+                    if lim.day == day: lim.unflushed += n
+            raise
+        today = datetime.date.today().isoformat()
+        usage = self.db.query("SELECT scope, key, sent FROM rate_usage WHERE day=?", (today,))
+        with self._lock:
+            for scope, key, sent in usage:
+                lim = self._limits.get((scope, key))
+                if lim and lim.day == today: lim.sent_today = sent + lim.unflushed
+
+    def get_quota(self, scope, key):
+        return self._quotas.get((scope, key), (None, None))
+
+    def daily_capacity(self, account):
+        """账号今天还能发送的邮件数：设置了每日配额时为剩余配额，否则按每分钟速率估算一整天的量 (不限速时为 UNLIMITED_DAILY)"""
+        with self._lock:
+            lim = self._limit("account", account)
+            if lim.per_day: return max(0, lim.per_day - lim.sent_today)
+            return lim.max_rate * 86400 if lim.max_rate else self.UNLIMITED_DAILY
+
+    def set_quota(self, scope, key, per_minute, per_day):
+        self.db.execute("INSERT OR REPLACE INTO rate_limits (scope, key, per_minute, per_day) VALUES (?,?,?,?)",
+                        (scope, key, per_minute, per_day))
+        self.reload()
+
+# ==========================================
+# 失败重试
+# ==========================================
+
+# 没有 SMTP 响应码时，网络类错误 (断线、超时、DNS 解析失败、网络不可达、TLS 握手失败等 OSError) 视为临时错误；
+# 附件缺失、无权限等本地文件错误，以及其余 smtplib 错误 (如服务器不支持 STARTTLS) 重试也不会成功
+PERMANENT_ERRORS = (FileNotFoundError, PermissionError, IsADirectoryError, NotADirectoryError, smtplib.SMTPException)
+
+def classify_error(code, exc=None):
+    """错误分类：throttle 为服务商限流，transient 为其他临时错误 (4xx、网络中断)，permanent 为永久错误 (5xx 等)。
+    exc 为 None 表示单个收件人的 RCPT 响应：这时的 45x 多是灰名单或个别邮箱的问题，只按普通临时错误重试这个收件人，
+    不让账号和主机整体降速；421 和 MAIL/DATA 阶段的 45x (整封邮件被拒) 才算限流。"""
+    if code in THROTTLE_CODES and exc is not None: return "throttle"
+    if code: return "transient" if 400 <= code < 500 else "permanent"
+    if isinstance(exc, smtplib.SMTPServerDisconnected): return "transient"
+    return "transient" if isinstance(exc, OSError) and not isinstance(exc, PERMANENT_ERRORS) else "permanent"
+
+class RetryPolicy:
+    """临时错误的重试间隔：按重试次数指数增长 (base, 2*base, 4*base ... 不超过 cap)，在 [一半, 全部] 之间随机取值，
+    避免同一批失败的邮件在同一时刻一起重试。重试只是按新的发送时间重新排队，不占用发送线程。"""
+    def __init__(self, max_attempts=5, base=30, cap=3600):
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt):
+        d = min(self.cap, self.base * 2 ** (attempt - 1))
+        return random.uniform(d / 2, d)
+
+# ==========================================
+# 多账号分发
+# ==========================================
+
+class AccountRouter:
+    """在多个发件账号 (accounts 表) 之间分配收件人：
+    round_robin 轮流使用；weighted 按各账号今天剩余的配额 (乘以 weight) 平滑加权轮询；
+    domain 同一收件域名固定使用同一账号 (最高随机权重哈希，某个账号暂停时只有它的域名会改用其他账号)。
+    账号达到配额或登录失败时暂停一段时间，期间不再分配，已分配的邮件由引擎改派给其他账号。"""
+    STRATEGIES = {"round_robin": "轮询", "weighted": "按配额", "domain": "按收件域名"}
+
+    def __init__(self, db, rate_limiter):
+        self.db = db
+        self.rate_limiter = rate_limiter
+        self._lock = threading.Lock()
+        self._suspended = {}  # 邮箱 -> (暂停到的时间戳, 原因)
+        self.reload()
+
+    def reload(self):
+        with self._lock:
+            self.accounts = self.db.list_accounts(enabled_only=True)
+            self._rr = 0
+            self._current = collections.Counter()  # 平滑加权轮询的当前权重
+
+    def suspend(self, email, seconds, reason):
+        with self._lock: self._suspended[email] = (time.time() + seconds, reason)
+
+    def suspended(self, email):
+        """账号暂停的原因，未暂停时返回 None"""
+        until, reason = self._suspended.get(email, (0, None))
+        return reason if until > time.time() else None
+
+    def pick(self, recipient, strategy="round_robin", exclude=()):
+        """为收件人选一个可用账号，返回账号字典；没有可用账号时返回 None"""
+        candidates = [a for a in self.accounts if a["email"] not in exclude and not self.suspended(a["email"])]
+        if not candidates: return None
+        if strategy == "domain":
+            domain = recipient.rpartition("@")[2].lower()
+            return max(candidates, key=lambda a: zlib.crc32(f"{domain}|{a['email']}".encode()))
+        with self._lock:
+            if strategy == "weighted":
+                weights = {a["email"]: self.rate_limiter.daily_capacity(a["email"]) * (a["weight"] or 1) for a in candidates}
+                total = sum(weights.values())
+                if total > 0:
+                    for email, w in weights.items(): self._current[email] += w
+                    best = max(candidates, key=lambda a: self._current[a["email"]])
+                    self._current[best["email"]] -= total
+                    return best
+            self._rr += 1
+            return candidates[self._rr % len(candidates)]
+
+# ==========================================
+# 定时调度
+# ==========================================
+
+class Scheduler:
+    """按发送时间排序的最小堆：线程睡到最近一封邮件到期，新任务或提前发送时立即唤醒。
+    改期的邮件直接压入新条目，旧条目在出堆时由 dispatch 自行判断并丢弃。"""
+    def __init__(self, dispatch, housekeeping=None, housekeeping_interval=1.0):
+        self.dispatch = dispatch
+        self.housekeeping = housekeeping
+        self.housekeeping_interval = housekeeping_interval
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def schedule(self, key, when):
+        with self._cond:
+            heapq.heappush(self._heap, (when, next(self._seq), key))
+            if self._heap[0][2] == key: self._cond.notify()
+
+    def schedule_many(self, items):
+        with self._cond:
+            for key, when in items: self._heap.append((when, next(self._seq), key))
+            heapq.heapify(self._heap)
+            self._cond.notify()
+
+    def wake(self):
+        with self._cond: self._cond.notify()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.time()
+                timeout = self._heap[0][0] - now if self._heap else None
+                if self.housekeeping: timeout = self.housekeeping_interval if timeout is None else min(timeout, self.housekeeping_interval)
+                if timeout is None or timeout > 0: self._cond.wait(timeout)
+                now = time.time()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap)[2])
+            try:
+                if due: self.dispatch(due)
+                if self.housekeeping: self.housekeeping()
+            except Exception as e: print(f"调度线程异常: {e}")
+
+# ==========================================
+# 持久化发送队列
+# ==========================================
+
+class QueueStore:
+    """把发送队列保存到 queue 表，程序关闭或崩溃后可以恢复；状态变更先攒在内存里再批量写入。
+    每次群发的模板、附件保存在 campaigns 表中，queue 表每行只记录收件人、发件账号、状态和模板字段的取值。
+    多个进程 (图形界面、cli.py run、cli.py send) 共用 queue 表：每行记录占用它的进程 (owner) 和占用期限，
+    进程定时续期，只接管无人占用或占用已过期 (进程已退出) 的邮件，同一封邮件不会被两个进程发送。"""
+    STATES = {"等待中": "waiting", "发送中": "sending", "已发送": "sent", "失败": "failed"}
+    LABELS = {v: k for k, v in STATES.items()}
+    COLUMNS = ("id", "name", "email", "sender", "pwd", "server", "send_at", "campaign_id", "fields")
+    INSERT_SQL = (f"INSERT OR REPLACE INTO queue ({', '.join(COLUMNS)}, state, updated_at, owner, lease_until) "
+                  f"VALUES ({', '.join('?' * (len(COLUMNS) + 4))})")
+    CAMPAIGN_COLUMNS = ("id", "subject", "content", "sender", "pwd", "server", "attachments", "strategy", "fields")
+    # 旧版本的行没有 campaign_id，主题和正文是按收件人渲染好的，保存在 subject、content 等列中
+    SELECT_SQL = ("SELECT id, name, email, sender, pwd, server, send_at, state, error, attempts, campaign_id, fields, "
+                  "subject, content, attachments, strategy FROM queue")
+    LEASE = 60  # 占用期限 (秒)，每 LEASE/3 秒续期一次
+
+
+    def __init__(self, db):
+        self.db = db
+        self._updates = {}   # id -> (state, send_at, error, attempts, 发件账号)，同一封邮件的多次变更只写最后一次
+        self._removed = set()
+        self._lock = threading.Lock()
+        self._campaigns = weakref.WeakValueDictionary()  # 已加载的群发，后加入的同一群发的邮件共用同一个对象
+        self.owner = uuid.uuid4().hex
+        self._renewed = 0
+
+    def add_many(self, entries, claim=True):
+        """在一个事务里写入一批新邮件及其所属的群发；claim 为 False 时不占用，留给 run 或图形界面发送"""
+        now = time.time()
+        owner, lease = (self.owner, now + self.LEASE) if claim else (None, None)
+        campaigns = {d.campaign.id: d.campaign for d in entries}
+        with self.db.transaction() as conn:
+            conn.executemany(f"INSERT OR IGNORE INTO campaigns ({', '.join(self.CAMPAIGN_COLUMNS)}, created_at) "
+                             f"VALUES ({', '.join('?' * (len(self.CAMPAIGN_COLUMNS) + 1))})",
+                             [(c.id, c.subject, c.content, *c.account, json.dumps(c.attachments), c.strategy, json.dumps(c.fields), now)
+                              for c in campaigns.values()])
+            conn.executemany(self.INSERT_SQL, [(d.id, d.name, d.email, *d.account, d.send_at, d.campaign.id,
+                                                json.dumps(d.values, ensure_ascii=False), self.STATES[d.status], now, owner, lease) for d in entries])
+        self._campaigns.update(campaigns)
+
+    def update(self, data):
+        with self._lock:
+            self._updates[data.id] = (self.STATES[data.status], data.send_at, data.error, data.attempts, *data.account)
+
+    def remove(self, ids):
+        with self._lock:
+            for eid in ids:
+                self._updates.pop(eid, None)
+                self._removed.add(eid)
+
+    def flush(self):
+        with self._lock:
+            updates, self._updates = self._updates, {}
+            removed, self._removed = self._removed, set()
+        if not updates and not removed: return
+        now = time.time()
+        try:
+            with self.db.transaction() as conn:
+                conn.executemany("UPDATE queue SET state=?, send_at=?, error=?, attempts=?, sender=?, pwd=?, server=?, updated_at=? WHERE id=?",
+                                 [u + (now, eid) for eid, u in updates.items()])
+                conn.executemany("DELETE FROM queue WHERE id=?", [(eid,) for eid in removed])
+        except Exception:
+            # 写入失败 (如其他进程导入联系人时数据库忙)：放回缓冲，下次再写；期间的新变更优先
+            with self._lock:
+                for eid, u in updates.items():
+                    if eid not in self._removed: self._updates.setdefault(eid, u)
+                self._removed |= removed
+            raise
+
+    def renew(self):
+        """续期本进程占用的邮件，由调度器的定时任务调用"""
+        now = time.time()
+        if now - self._renewed < self.LEASE / 3: return
+        self._renewed = now
+        self.db.execute("UPDATE queue SET lease_until=? WHERE owner=?", (now + self.LEASE, self.owner))
+
+    def release(self):
+        """退出前放弃占用，剩下的邮件可以立即由其他进程接管"""
+        self.db.execute("UPDATE queue SET owner=NULL, lease_until=NULL WHERE owner=?", (self.owner,))
+
+    def _claim(self, conn, where):
+        now = time.time()
+        conn.execute(f"UPDATE queue SET owner=?, lease_until=? WHERE {where} AND (owner IS NULL OR owner=? OR lease_until < ?)",
+                     (self.owner, now + self.LEASE, self.owner, now))
+
+    def load_pending(self):
+        """启动时接管未完成的邮件；上次停在"发送中"的邮件无法确认结果，重新排队 (仍在运行的其他进程占用的邮件除外)"""
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM queue WHERE state='sent'")
+            self._claim(conn, "1")
+            conn.execute("UPDATE queue SET state='waiting' WHERE state='sending' AND owner=?", (self.owner,))
+            conn.execute("DELETE FROM campaigns WHERE id NOT IN (SELECT campaign_id FROM queue WHERE campaign_id IS NOT NULL)")
+        return self._entries(self.db.query(self.SELECT_SQL + " WHERE owner=? ORDER BY send_at", (self.owner,)))
+
+    def load_waiting(self, exclude=()):
+        """接管等待中、且 id 不在 exclude 里的邮件 (send --no-wait 等加入、或占用进程已退出的邮件)"""
+        with self.db.transaction() as conn: self._claim(conn, "state='waiting'")
+        rows = self.db.query(self.SELECT_SQL + " WHERE state='waiting' AND owner=?", (self.owner,))
+        return self._entries([r for r in rows if r[0] not in exclude])
+
+    def _entries(self, rows):
+        campaigns = {cid: self._campaigns.get(cid) for cid in {r[10] for r in rows if r[10]}}
+        missing = [cid for cid, c in campaigns.items() if c is None]
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            for c in self.db.query(f"SELECT {', '.join(self.CAMPAIGN_COLUMNS)} FROM campaigns WHERE id IN ({', '.join('?' * len(chunk))})", chunk):
+                cid, subject, content, sender, pwd, server, attachments, strategy, fields = c
+                campaigns[cid] = self._campaigns[cid] = Campaign(cid, subject, content, sender, pwd, server, json.loads(attachments or "[]"),
+                                                                 strategy, json.loads(fields or "[]"))
+        accounts, entries = {}, []
+        for r in rows:
+            eid, name, email, sender, pwd, server, send_at, state, error, attempts, cid, fields = r[:12]
+            campaign = campaigns.get(cid)
+            if campaign is None:
+                if cid: continue  # 群发记录缺失，无法渲染
+                subject, content, attachments, strategy = r[12:]
+                campaign = Campaign(None, subject or "", content or "", sender, pwd, server, json.loads(attachments or "[]"), strategy)
+            account = accounts.setdefault((sender, pwd, server), (sender, pwd, server))
+            entries.append(Recipient(eid, campaign, name, email, tuple(json.loads(fields or "[]")),
+                                     None if account == campaign.account else account, send_at,
+                                     self.LABELS.get(state, "等待中"), error or None, attempts or 0))
+        return entries
+
+# ==========================================
+# 附件编码缓存
+# ==========================================
+
+class AttachmentCache:
+    """按 (路径, 修改时间, 大小) 缓存 base64 编码后的附件，同一批邮件共用一份。
+    队列中引用某个附件的邮件全部发完或撤回后即释放；超过内存上限的条目写入临时文件。"""
+    ENCODE_BLOCK = 57 * 1024  # 57 字节原文正好编码成一行 76 字符
+
+    def __init__(self, max_memory=64 * 1024 * 1024):
+        self.max_memory = max_memory
+        self._entries = {}   # key -> str (内存中) 或 ("file", 临时文件路径)
+        self._refs = collections.Counter()
+        self._memory = 0
+        self._spill_dir = None
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    @staticmethod
+    def _key(path):
+        st = os.stat(path)
+        return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+    def retain(self, paths, count=1):
+        with self._lock:
+            for p in paths: self._refs[os.path.abspath(p)] += count
+
+    def release(self, paths):
+        with self._lock:
+            for p in paths:
+                p = os.path.abspath(p)
+                self._refs[p] -= 1
+                if self._refs[p] <= 0:
+                    del self._refs[p]
+                    self._evict(p)
+
+    def _evict(self, abspath):
+        for key in [k for k in self._entries if k[0] == abspath]:
+            entry = self._entries.pop(key)
+            self._key_locks.pop(key, None)
+            if isinstance(entry, tuple):
+                try: os.remove(entry[1])
+                except OSError: pass
+            else: self._memory -= len(entry)
+
+    def clear(self):
+        """丢弃全部缓存，并删除存放大附件的临时目录"""
+        with self._lock:
+            for p in {k[0] for k in self._entries}: self._evict(p)
+            self._refs.clear()
+            if self._spill_dir: shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
+    def load(self, path):
+        """读取并编码附件 (已缓存时直接返回)，返回的条目交给 iter_encoded；文件不存在或无法读取时抛出 OSError"""
+        key = self._key(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None: return entry
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock: entry = self._entries.get(key)
+            if entry is not None: return entry
+            # base64 后约为原大小的 4/3，再加上每 76 字符一个 CRLF
+            estimate = key[2] * 4 // 3 + key[2] // 28 + 2
+            with self._lock: fits = self._memory + estimate <= self.max_memory
+            if fits:
+                with open(path, 'rb') as f: entry = base64.encodebytes(f.read()).replace(b"\n", b"\r\n")
+            else:
+                # 放不进内存的附件分块编码，直接写入临时文件
+                with self._lock:
+                    if self._spill_dir is None: self._spill_dir = tempfile.mkdtemp(prefix="autoemail_")
+                fd, spill = tempfile.mkstemp(dir=self._spill_dir, suffix=".b64")
+                with open(path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+                    for block in iter(lambda: src.read(self.ENCODE_BLOCK), b""):
+                        dst.write(base64.encodebytes(block).replace(b"\n", b"\r\n"))
+                entry = ("file", spill)
+            with self._lock:
+                self._entries[key] = entry
+                if not isinstance(entry, tuple): self._memory += len(entry)
+            return entry
+
+    @staticmethod
+    def iter_encoded(entry, chunk_size=78 * 3360):
+        """分块返回 load() 得到的 base64 内容 (CRLF 换行，每行 76 字符)；
+        chunk_size 是整行长度 (78) 的倍数，保证每块都从行首开始"""
+        if isinstance(entry, tuple):
+            with open(entry[1], 'rb') as f:
+                yield from iter(lambda: f.read(chunk_size), b"")
+        else:
+            view = memoryview(entry)
+            for i in range(0, len(entry), chunk_size): yield view[i:i + chunk_size]
+
+# ==========================================
+# 流式邮件组装
+# ==========================================
+
+def build_skeleton(sender, to, subject, content, attachments):
+    """用 email 库渲染邮件骨架，附件位置放占位符；返回 (已做点填充的 DATA 内容, [(占位符, 附件路径)])。
+    只依赖参数，可以在渲染进程池中执行。"""
+    msg = MIMEMultipart()
+    msg['From'] = sender
+    msg['To'] = to
+    msg['Subject'] = subject
+    msg.attach(MIMEText(content, 'plain', 'utf-8'))
+    parts = []
+    for fpath in attachments:
+        marker = f"AUTOEMAIL-ATTACHMENT-{uuid.uuid4().hex}"
+        part = MIMEBase('application', 'octet-stream')
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.set_payload(marker)
+        # filename 参数按 RFC 2231 编码，中文文件名才能被收件端正确识别
+        part.add_header('Content-Disposition', 'attachment', filename=os.path.basename(fpath))
+        msg.attach(part)
+        parts.append((marker.encode('ascii'), fpath))
+    buf = io.BytesIO()
+    BytesGenerator(buf, policy=msg.policy.clone(linesep="\r\n")).flatten(msg)
+    return _LEADING_DOT.sub(b'..', buf.getvalue()), parts
+
+class StreamingMessage:
+    """分块生成的 multipart 邮件：头部和正文先用 email 库渲染成一个很小的骨架，
+    附件位置放占位符，发送时再把附件的 base64 内容分块填进去，内存占用与附件大小无关"""
+    def __init__(self, data, attach_cache, to=None):
+        self.data = data
+        self.attach_cache = attach_cache
+        self.to = to or data.email
+        self._skeleton = None
+        self._encoded = None
+
+    def prepare(self, skeleton=None):
+        """提前渲染骨架 (连接重试时复用) 并读取全部附件，附件缺失时在 MAIL FROM 之前就报错，不会中断 DATA；
+        skeleton 为渲染进程池已经算好的结果。返回自身"""
+        self._skeleton = skeleton or self.skeleton()
+        self._encoded = [self.attach_cache.load(fpath) for _, fpath in self._skeleton[1]]
+        return self
+
+    def skeleton(self):
+        data = self.data
+        return build_skeleton(data.sender, self.to, data.subject, data.content, data.attachments)
+
+    def chunks(self):
+        """产出 DATA 内容 (已做点填充)：骨架在渲染时已处理，base64 行只含字母、数字和 +/=，不会以 "." 开头"""
+        if self._skeleton is None: self.prepare()
+        rest, parts = self._skeleton
+        for (marker, _), entry in zip(parts, self._encoded):
+            head, rest = rest.split(marker, 1)
+            yield head
+            yield from self.attach_cache.iter_encoded(entry)
+        if not rest.endswith(b"\r\n"): rest += b"\r\n"
+        yield rest
+
+class RenderPool:
+    """可选的多进程渲染：调度器把到期的邮件交给发送池的同时登记到这里，由进程池提前渲染骨架 (MIME 构建、编码、点填充)，
+    最多领先发送线程 prefetch 批，避免大批量时渲染结果堆积在内存里；发送线程取到现成的结果直接发送，还没轮到的自己渲染。
+    附件的 base64 由主进程的 AttachmentCache 共享，不经过进程池，大块数据不必在进程间复制。"""
+    def __init__(self, processes, prefetch=None):
+        from concurrent.futures import ProcessPoolExecutor
+        self.executor = ProcessPoolExecutor(max_workers=processes)
+        self.prefetch = prefetch or processes * 4
+        self._waiting = collections.OrderedDict()  # 批次 (第一封邮件的 id) -> (批次, 收件人栏)，提交时才渲染主题和正文
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def add(self, batch, to):
+        with self._lock:
+            self._waiting[batch[0].id] = (batch, to)
+            self._fill()
+
+    def _fill(self):
+        while self._waiting and len(self._futures) < self.prefetch:
+            key, (batch, to) = self._waiting.popitem(last=False)
+            d = batch[0]
+            self._futures[key] = self.executor.submit(build_skeleton, d.sender, to, d.subject, d.content, d.attachments)
+
+    def take(self, batch):
+        """取走这一批的渲染任务并补充新的任务；还没提交给进程池时返回 None"""
+        key = batch[0].id
+        with self._lock:
+            self._waiting.pop(key, None)
+            future = self._futures.pop(key, None)
+            self._fill()
+        return future
+
+    @staticmethod
+    def result(future):
+        """等待渲染结果；没有任务或渲染出错时返回 None，由调用方自己渲染"""
+        if future is None: return None
+        try: return future.result()
+        except Exception as e:
+            print(f"渲染进程异常: {e}"); return None
+
+    def shutdown(self):
+        with self._lock: self._waiting.clear()
+        for f in self._futures.values(): f.cancel()
+        self.executor.shutdown(wait=False)
+
+# ==========================================
+# 邮件模板渲染
+# ==========================================
+
+PLACEHOLDER_ALIASES = {"姓名": "name", "邮箱": "email", "职称": "title", "院系": "department"}
+
+class CompiledTemplate:
+    """预编译的模板：解析一次占位符位置，渲染时只做一次 format_map。
+    占位符可以是中文别名 ({姓名}) 或 contacts 表的任意列名 ({name})；不认识的花括号内容原样保留。"""
+    _PLACEHOLDER = re.compile(r"\{([^{}\s]+)\}")
+
+    def __init__(self, text, columns):
+        pieces, self.fields, pos = [], set(), 0
+        for m in self._PLACEHOLDER.finditer(text):
+            key = PLACEHOLDER_ALIASES.get(m.group(1), m.group(1))
+            if key not in columns: continue
+            pieces.append(text[pos:m.start()].replace("{", "{{").replace("}", "}}"))
+            pieces.append("{" + key + "}")
+            self.fields.add(key)
+            pos = m.end()
+        pieces.append(text[pos:].replace("{", "{{").replace("}", "}}"))
+        self._format = "".join(pieces)
+
+    def render(self, values):
+        return self._format.format_map(values)
+
+class ContactFields(dict):
+    """渲染用的联系人字段，缺失或为空的列按空字符串处理"""
+    def __missing__(self, key):
+        return ""
+
+# ==========================================
+# 群发与收件人记录
+# ==========================================
+
+class Campaign:
+    """一次群发：主题和正文模板、默认发件账号和附件只保存一份，由所有收件人共用。
+    fields 为模板中实际用到的字段，收件人按这个顺序保存各自的取值。"""
+    def __init__(self, id, subject, content, sender, pwd, server, attachments=(), strategy=None, columns=()):
+        self.id = id
+        self.subject, self.content = subject, content  # 模板原文，保存到 campaigns 表
+        self.subject_tmpl = CompiledTemplate(subject, columns)
+        self.content_tmpl = CompiledTemplate(content, columns)
+        self.fields = tuple(sorted(self.subject_tmpl.fields | self.content_tmpl.fields))
+        self.account = (sender, pwd, server)
+        self.attachments = tuple(attachments)
+        self.strategy = strategy
+
+    def values(self, fields):
+        """从收件人的全部字段中取出模板用到的值"""
+        return tuple(fields[k] for k in self.fields)
+
+class Recipient:
+    """队列中的一封邮件：只保存收件人自己的信息和发送状态，主题和正文在用到时按所属 Campaign 的模板渲染。
+    account 为 (发件邮箱, 授权码, SMTP 服务器)，默认共用 Campaign 的账号，按策略分配或改派时单独设置。"""
+    __slots__ = ("id", "campaign", "name", "email", "values", "account", "send_at", "status", "error", "attempts")
+
+    def __init__(self, id, campaign, name, email, values=(), account=None, send_at=0.0, status="等待中", error=None, attempts=0):
+        self.id, self.campaign, self.name, self.email, self.values = id, campaign, name, email, values
+        self.account = account or campaign.account
+        self.send_at, self.status, self.error, self.attempts = send_at, status, error, attempts
+
+    sender = property(lambda self: self.account[0])
+    pwd = property(lambda self: self.account[1])
+    server = property(lambda self: self.account[2])
+    attachments = property(lambda self: self.campaign.attachments)
+    strategy = property(lambda self: self.campaign.strategy)
+
+    @property
+    def subject(self):
+        return self.campaign.subject_tmpl.render(ContactFields(zip(self.campaign.fields, self.values)))
+
+    @property
+    def content(self):
+        return self.campaign.content_tmpl.render(ContactFields(zip(self.campaign.fields, self.values)))
+
+# ==========================================
+# 联系人批量导入
+# ==========================================
+
+IMPORT_HEADERS = {"姓名": 0, "name": 0, "邮箱": 1, "email": 1, "职称": 2, "title": 2, "院系": 3, "department": 3}
+_EMAIL = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+
+def valid_email(addr):
+    """粗略检查邮箱格式 (一个 @，域名中有点，不含空白)，导入和手动添加联系人时过滤明显无效的地址"""
+    return bool(addr and _EMAIL.fullmatch(addr))
+
+def _sniff_csv_encoding(path):
+    """Excel 另存的 CSV 常见 GBK 编码；前 1MB 能按 UTF-8 解码就按 UTF-8 处理"""
+    with open(path, 'rb') as f: head = f.read(1024 * 1024)
+    try: codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+    except UnicodeDecodeError: return 'gbk'
+    return 'utf-8-sig'
+
+def _iter_sheet(path):
+    """逐行读取 CSV 或 Excel (只读模式)，产出 (已处理行数, 估计总行数, 行)"""
+    if path.lower().endswith('.csv'):
+        with open(path, 'rb') as f: total = sum(block.count(b"\n") for block in iter(lambda: f.read(1 << 20), b""))
+        with open(path, newline='', encoding=_sniff_csv_encoding(path)) as f:
+            for i, row in enumerate(csv.reader(f), 1): yield i, total, row
+    else:
+        if not EXCEL_SUPPORT: raise RuntimeError("未安装 openpyxl，无法读取 Excel 文件")
+        import openpyxl
+        wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            ws = wb.active
+            total = ws.max_row or 0
+            for i, row in enumerate(ws.iter_rows(values_only=True), 1): yield i, total, row
+        finally: wb.close()
+
+def iter_contact_rows(path):
+    """逐行读取联系人文件，产出 (已处理行数, 估计总行数, [姓名, 邮箱, 职称, 院系])；
+    第一行按表头识别列顺序，姓名为空或邮箱无效的行产出 None"""
+    columns = (0, 1, 2, 3)
+    for i, total, row in _iter_sheet(path):
+        cells = ["" if v is None else str(v).strip() for v in row]
+        if i == 1:
+            mapped = {IMPORT_HEADERS[c.lower()]: n for n, c in enumerate(cells) if c.lower() in IMPORT_HEADERS}
+            if 0 in mapped and 1 in mapped:
+                columns = tuple(mapped.get(k, -1) for k in range(4))
+            continue  # 第一行是表头
+        rec = [cells[c] if 0 <= c < len(cells) else "" for c in columns]
+        yield i, total, (rec if rec[0] and valid_email(rec[1]) else None)
+
+def import_contacts(db, path, progress=None, chunk_size=1000):
+    """流式导入联系人：分块 executemany，整个文件一个事务，按邮箱去重 (已存在则更新)。
+    progress(done, total) 在每个分块写入后调用。返回 (导入行数, 跳过行数)。"""
+    imported = skipped = 0
+    batch = []
+    with db.transaction():
+        for i, total, rec in iter_contact_rows(path):
+            if rec is None:
+                skipped += 1; continue
+            batch.append(rec)
+            if len(batch) >= chunk_size:
+                db.upsert_contacts(batch)
+                imported += len(batch); batch = []
+                if progress: progress(i, total)
+        if batch: db.upsert_contacts(batch)
+        imported += len(batch)
+    return imported, skipped
+
+# ==========================================
+# 发送引擎
+# ==========================================
+
+class MailEngine:
+    """不依赖界面的发送引擎：渲染、持久化队列、定时调度、限速、SMTP 发送和历史记录。
+    图形界面和命令行共用同一个引擎；发送线程只在 dirty 中登记状态有变化的邮件 id，由使用方轮询 take_changes()。"""
+    def __init__(self, db):
+        self.db = db
+        self.pending_emails = {}
+        self.pending_lock = threading.RLock()  # 多个发送线程并发修改队列状态
+        self.dirty = set()                     # 状态有变化、尚未被使用方取走的邮件 id
+        self._finished = {}                    # 已发送并移出队列、结果尚未被取走的邮件
+        self.dead_letters = {}                 # 死信：永久失败或重试次数用完的邮件，等待使用方重新排队或清除
+        self.metrics = Metrics()
+        self.smtp_pool = SMTPConnectionPool(metrics=self.metrics)
+        # 发送记录先进内存队列，由后台线程批量写入，不占用发送线程
+        self.history_writer = BatchWriter(self._write_history, name="HistoryWriter")
+        self.rate_limiter = RateLimiter(db)
+        self.accounts = AccountRouter(db, self.rate_limiter)
+        self.queue_store = QueueStore(db)
+        self.attach_cache = AttachmentCache(int(db.get_config("attachment_cache_mb", 64)) * 1024 * 1024)
+        self.retry = RetryPolicy(int(db.get_config("retry_max_attempts", 5)), float(db.get_config("retry_base_seconds", 30)),
+                                 float(db.get_config("retry_max_seconds", 3600)))
+        self.sender_pool = None
+        self.scheduler = None
+        self.render_pool = None
+        self.metrics_server = None
+        self.metrics_file = None
+        self._metrics_written = 0
+        self.max_rcpt = 1
+        self._rcpt_limits = {}  # 服务器 -> 实际接受的每封邮件收件人上限 (遇到 452 时得知)
+
+    def start(self, load_pending=True):
+        """启动发送线程和调度器；load_pending 为 True 时恢复 queue 表中未完成的邮件"""
+        self.sender_pool = SenderPool(self._send_mail,
+                                      max_workers=int(self.db.get_config("max_workers", 8)),
+                                      per_host=int(self.db.get_config("per_host_workers", 3)))
+        self.max_rcpt = max(1, int(self.db.get_config("max_rcpt_per_message", 50)))
+        self.scheduler = Scheduler(self._dispatch_due, housekeeping=self._housekeeping)
+        # render_processes：0 (默认) 在发送线程中渲染，N 使用 N 个渲染进程，auto 按 CPU 核数
+        processes = str(self.db.get_config("render_processes", 0) or 0)
+        processes = (os.cpu_count() or 1) if processes == "auto" else int(processes)
+        if processes > 0:
+            self.render_pool = RenderPool(processes, int(self.db.get_config("render_prefetch", 0) or 0) or None)
+        if load_pending: self.adopt(self.queue_store.load_pending())
+        self.scheduler.start()
+
+    def adopt(self, entries):
+        """接管已经写入 queue 表的邮件 (启动恢复，或其他进程新加入的邮件)"""
+        with self.pending_lock:
+            for d in entries:
+                if d.id in self.pending_emails or d.id in self.dead_letters: continue
+                self.dirty.add(d.id)
+                if d.status == "失败":
+                    self.dead_letters[d.id] = d; continue
+                self.pending_emails[d.id] = d
+                self.attach_cache.retain(d.attachments)
+                if d.status == "等待中": self.scheduler.schedule(d.id, d.send_at)
+
+    def shutdown(self):
+        """停止前把缓冲中的队列状态、用量和历史记录写入数据库，并关闭 SMTP 会话"""
+        self.queue_store.flush()
+        self.queue_store.release()
+        self.rate_limiter.flush()
+        self.smtp_pool.close_all()
+        self.history_writer.close()
+        if self.render_pool: self.render_pool.shutdown()
+        self.attach_cache.clear()
+        if self.metrics_file: self.metrics.write_file(self.metrics_file)
+        if self.metrics_server: self.metrics_server.shutdown(); self.metrics_server.server_close()
+
+    # ---------- 指标导出 ----------
+    METRICS_FILE_INTERVAL = 15  # 指标文件的刷新间隔 (秒)
+
+    def export_metrics(self, port=None, path=None):
+        """按参数或配置 (metrics_port、metrics_file) 开启 Prometheus 指标导出，都未设置时不导出"""
+        port = int(port if port is not None else self.db.get_config("metrics_port", 0) or 0)
+        self.metrics_file = path or self.db.get_config("metrics_file") or None
+        if port and not self.metrics_server: self.metrics_server = self.metrics.serve(port)
+
+    def _housekeeping(self):
+        self.queue_store.flush()
+        self.queue_store.renew()
+        if self.metrics_file and time.monotonic() - self._metrics_written >= self.METRICS_FILE_INTERVAL:
+            self._metrics_written = time.monotonic()
+            try: self.metrics.write_file(self.metrics_file)
+            except OSError as e: print(f"写入指标文件失败: {e}")
+
+    # ---------- 加入队列 ----------
+    def render(self, recipients, subject, body, sender, pwd, server, attachments=(), send_at=None, strategy=None):
+        """生成一次群发的队列条目：模板、发件账号和附件只在 Campaign 中保存一份，每个收件人只记录模板用到的字段值，
+        主题和正文在发送时才渲染。recipients 为字段字典 (至少含 name、email)，
+        其余字段优先取自字典中的非空值，再取通讯录中同邮箱联系人的记录。
+        strategy 为 AccountRouter.STRATEGIES 之一时忽略 sender/pwd/server，按策略把收件人分给多个发件账号。"""
+        recipients = list(recipients)
+        if strategy: self.accounts.reload()
+        elif not (server or "").strip(): raise ValueError("未设置 SMTP 服务器")
+        columns = set(self.db.contact_columns()).union(*(r.keys() for r in recipients))
+        contacts = self.db.fetch_contacts_by_email([r["email"] for r in recipients], ContactFields)
+        campaign = Campaign(uuid.uuid4().hex, subject, body, sender, pwd, server, attachments, strategy, columns)
+        send_at = time.time() if send_at is None else send_at
+        stamp = int(time.time() * 1000)
+        routed = {}  # 发件邮箱 -> (邮箱, 授权码, 服务器)，分给同一账号的收件人共用一个元组
+        entries = []
+        for count, r in enumerate(recipients):
+            fields = contacts.get(r["email"]) or ContactFields()
+            fields.update((k, v) for k, v in r.items() if v not in (None, ""))
+            account = None
+            if strategy:
+                acct = self.accounts.pick(fields["email"], strategy)
+                if acct is None: raise ValueError("没有可用的发件账号")
+                account = routed.setdefault(acct["email"], (acct["email"], acct["pwd"], acct["smtp"]))
+            entries.append(Recipient(f"{stamp}_{count}", campaign, fields["name"], fields["email"],
+                                     campaign.values(fields), account, send_at))
+        return entries
+
+    def enqueue(self, entries):
+        # 先落盘再进入内存队列，保证看到的邮件在重启后都还在
+        self.queue_store.add_many(entries)
+        with self.pending_lock:
+            for d in entries:
+                self.attach_cache.retain(d.attachments)
+                self.pending_emails[d.id] = d
+                self.dirty.add(d.id)
+        self.scheduler.schedule_many((d.id, d.send_at) for d in entries)
+        return entries
+
+    # ---------- 队列操作 ----------
+    def take_changes(self, full=False):
+        """取走自上次调用以来状态有变化的邮件，返回 [(id, (姓名, 邮箱, 状态, 发送时间, 错误) 或 None 表示已撤回)]；
+        full 为 True 时同时返回队列中的全部邮件，用于第一次构建表格"""
+        with self.pending_lock:
+            dirty, self.dirty = self.dirty, set()
+            finished, self._finished = self._finished, {}
+            if full: dirty.update(self.pending_emails, self.dead_letters)
+            changes = []
+            for eid in dirty:
+                d = self.pending_emails.get(eid) or self.dead_letters.get(eid) or finished.get(eid)
+                changes.append((eid, d and (d.name, d.email, d.status, d.send_at, d.error)))
+        return changes
+
+    def send_all_now(self):
+        with self.pending_lock:
+            for d in self.pending_emails.values():
+                if d.status == "等待中":
+                    d.send_at = time.time()
+                    self._persist(d)
+                    self.scheduler.schedule(d.id, d.send_at)
+
+    def withdraw(self, ids):
+        """撤回邮件，返回实际撤回的 id；已经开始发送的邮件不能撤回"""
+        with self.pending_lock:
+            removed = [eid for eid in ids if eid in self.pending_emails and self.pending_emails[eid].status != "发送中"]
+            for eid in removed: self.attach_cache.release(self.pending_emails.pop(eid).attachments)
+            self.dirty.update(removed)
+        self.queue_store.remove(removed)
+        self.scheduler.wake()
+        return removed
+
+    def requeue_dead(self, ids=None):
+        """把死信重新加入队列并立即发送 (ids 为 None 时处理全部死信)，重试次数清零；返回处理的 id"""
+        now = time.time()
+        with self.pending_lock:
+            ids = [eid for eid in (self.dead_letters if ids is None else ids) if eid in self.dead_letters]
+            for eid in ids:
+                d = self.dead_letters.pop(eid)
+                d.status, d.send_at, d.attempts, d.error = "等待中", now, 0, None
+                self.pending_emails[eid] = d
+                self.attach_cache.retain(d.attachments)
+                self._persist(d)
+        self.scheduler.schedule_many((eid, now) for eid in ids)
+        return ids
+
+    def purge_dead(self, ids=None):
+        """删除死信 (ids 为 None 时删除全部)，返回删除的 id"""
+        with self.pending_lock:
+            ids = [eid for eid in (self.dead_letters if ids is None else ids) if eid in self.dead_letters]
+            for eid in ids: del self.dead_letters[eid]
+            self.dirty.update(ids)
+        self.queue_store.remove(ids)
+        return ids
+
+    def account_progress(self):
+        """各发件账号的进度 {邮箱: (已发送, 待发送, 失败, 暂停原因或 None)}"""
+        # 从账号列表出发，暂停中、队列里没有邮件的账号也要显示
+        progress = {a["email"]: [0, 0, 0] for a in self.accounts.accounts}
+        for email, n in self.metrics.by_label("sent", "account").items(): progress.setdefault(email, [0, 0, 0])[0] = n
+        with self.pending_lock:
+            for d in self.pending_emails.values(): progress.setdefault(d.sender, [0, 0, 0])[1] += 1
+            for d in self.dead_letters.values(): progress.setdefault(d.sender, [0, 0, 0])[2] += 1
+        return {email: (*p, self.accounts.suspended(email)) for email, p in progress.items()}
+
+    def outstanding(self, ids=None):
+        """还在等待或发送中的邮件数 (ids 给出时只统计其中的邮件)"""
+        with self.pending_lock:
+            items = self.pending_emails.values() if ids is None else (self.pending_emails.get(i) for i in ids)
+            return sum(1 for d in items if d and d.status in ("等待中", "发送中"))
+
+    # ---------- 历史记录保留 ----------
+    def archive_path(self):
+        return self.db.get_config("history_archive", os.path.join(os.path.dirname(os.path.abspath(self.db.path)), 'email_archive.db'))
+
+    def archive_history(self, days):
+        """把 days 天以前的发送记录移入归档库，返回移动的条数"""
+        self.history_writer.flush()
+        before = (datetime.datetime.now() - datetime.timedelta(days=days)).isoformat(" ")
+        return self.db.archive_history(before, self.archive_path())
+
+    def apply_history_retention(self):
+        """在后台按保留天数 (config: history_retention_days，0 表示不归档) 把旧记录移入归档库"""
+        days = int(self.db.get_config("history_retention_days", 365))
+        if days <= 0: return
+        def work():
+            try: self.archive_history(days)
+            except Exception as e: print(f"归档历史记录失败: {e}")
+            finally: self.db.release()
+        threading.Thread(target=work, daemon=True).start()
+
+    # ---------- 发送 ----------
+    FAILOVER_WAIT = 60     # 限速等待超过该秒数 (通常是达到每日配额) 时，按策略分配的邮件改派给其他账号
+    AUTH_SUSPEND = 3600    # 登录失败的账号暂停分配的秒数
+
+    def _dispatch_due(self, eids):
+        """调度器取出到期的邮件 id，核对状态后交给发送池"""
+        now = time.time()
+        to_send = []
+        with self.pending_lock:
+            for eid in eids:
+                data = self.pending_emails.get(eid)
+                # 已撤回、已在发送或被改期到更晚的邮件，对应的是过期的堆条目
+                if not data or data.status != "等待中" or data.send_at > now: continue
+                data.status = "发送中"
+                self._persist(data)
+                to_send.append(data)
+        for d in to_send:
+            # 已分配的账号在排队期间被暂停 (达到配额或登录失败)，发送前改派
+            if d.strategy and self.accounts.suspended(d.sender):
+                acct = self.accounts.pick(d.email, d.strategy)
+                if acct:
+                    with self.pending_lock: d.account = (acct["email"], acct["pwd"], acct["smtp"])
+                    self._persist(d)
+        try: self.queue_store.flush()
+        except Exception as e: print(f"保存发送队列失败: {e}")  # 变更仍在缓冲中，不影响本次发送
+        for batch in self._group(to_send):
+            if self.render_pool: self.render_pool.add(batch, self._to_header(batch))
+            self.sender_pool.submit(batch[0].server, batch)
+
+    def _group(self, entries):
+        """把内容完全相同 (同一次群发、同一发件账号、模板字段取值相同) 的邮件合并成批，每批用一次 SMTP 事务发给多个收件人。
+        每批不超过 max_rcpt_per_message 配置和服务器实际接受的收件人数，同一批中不重复同一个邮箱。"""
+        batches, groups = [], {}
+        for d in entries:
+            key = (d.account, d.campaign, d.values)
+            limit = min(self.max_rcpt, self._rcpt_limits.get(d.server, self.max_rcpt))
+            group = groups.get(key)
+            if group is None or len(group[0]) >= limit or d.email in group[1]:
+                group = groups[key] = ([], set())
+                batches.append(group[0])
+            group[0].append(d); group[1].add(d.email)
+        return batches
+
+    def _persist(self, data):
+        """记录一封邮件的状态变化：写入持久化缓冲，并登记到 dirty"""
+        self.queue_store.update(data)
+        with self.pending_lock: self.dirty.add(data.id)
+
+    def _reschedule(self, data, delay, error=None):
+        with self.pending_lock:
+            if data.id not in self.pending_emails: return
+            if error: data.error = error  # 保留最近一次失败原因，队列中显示为等待重试
+            data.status = "等待中"
+            data.send_at = time.time() + delay
+            self._persist(data)
+        self.scheduler.schedule(data.id, data.send_at)
+
+    @staticmethod
+    def _to_header(batch):
+        # 多个收件人共用一封邮件时，To 中不列出其他人的地址
+        return batch[0].email if len(batch) == 1 else "undisclosed-recipients:;"
+
+    def _send_mail(self, batch):
+        """发送一批内容相同的邮件：一次 SMTP 事务，每个收件人一条 RCPT TO，按收件人分别记录结果"""
+        data = batch[0]
+        # 先取走进程池的渲染结果 (延后发送时丢弃，改派账号后 From 也会变化)，腾出预渲染的名额
+        rendering = self.render_pool.take(batch) if self.render_pool else None
+        delay = self.rate_limiter.acquire(data.sender, data.server, len(batch))
+        if delay:
+            self.metrics.inc("deferred")
+            if delay > self.FAILOVER_WAIT: batch = self._failover(batch, "达到配额", delay)
+            for d in batch: self._reschedule(d, delay)
+            return
+        try:
+            with self.metrics.span("mime"):
+                message = StreamingMessage(data, self.attach_cache, self._to_header(batch)).prepare(RenderPool.result(rendering))
+            refused = self.smtp_pool.send_stream(data.server, data.sender, data.pwd, [d.email for d in batch], message)
+            errors = describe_refusals(refused)
+        except smtplib.SMTPRecipientsRefused as e:
+            errors = describe_refusals(e.recipients)
+        except smtplib.SMTPAuthenticationError as e:
+            # 登录失败 (5xx)：暂停这个账号，按策略分配的邮件改由其他账号发送，其余的按永久错误处理；
+            # 4xx (如 454 临时认证失败) 不暂停账号，按临时错误重试
+            if not 400 <= e.smtp_code < 500:
+                batch = self._failover(batch, "登录失败", self.AUTH_SUSPEND)
+                if not batch: return
+            error = f"登录失败: {e.smtp_code} {e.smtp_error.decode(errors='replace') if isinstance(e.smtp_error, bytes) else e.smtp_error}"
+            errors = {d.email: (e.smtp_code, error, e) for d in batch}
+        except Exception as e:
+            errors = {d.email: (smtp_error_code(e), str(e), e) for d in batch}
+
+        sent = [d for d in batch if d.email not in errors]
+        if sent:
+            self.rate_limiter.on_success(data.sender, data.server)
+            self.metrics.inc("sent", len(sent), account=data.sender)
+        for d in sent: self._mark_sent(d)
+        if not errors: return
+        # 部分收件人收到 452 (收件人太多)：记下服务器的上限，这些收件人立即重新排队，按新上限分批
+        over = [i for i, d in enumerate(batch) if errors.get(d.email, (None,))[0] == 452]
+        if sent and over:
+            accepted = sum(1 for d in batch[:over[0]] if d.email not in errors)
+            self._rcpt_limits[data.server] = min(max(1, accepted), self._rcpt_limits.get(data.server, self.max_rcpt))
+        throttle_delay = None
+        for d in batch:
+            if d.email not in errors: continue
+            code, error, exc = errors[d.email]
+            if code == 452 and sent:
+                self._reschedule(d, 0); continue
+            kind = classify_error(code, exc)
+            d.attempts += 1
+            if kind != "permanent" and d.attempts < self.retry.max_attempts:
+                # 临时错误按退避时间重新排队；被限流时还要降低速率，等待时间取两者中较长的 (一批只降一次速)
+                delay = self.retry.delay(d.attempts)
+                if kind == "throttle":
+                    if throttle_delay is None: throttle_delay = self.rate_limiter.on_throttle(data.sender, data.server)
+                    delay = max(delay, throttle_delay)
+                self.metrics.inc("retries", reason=kind)
+                self._reschedule(d, delay, error); continue
+            self._dead_letter(d, code, error)
+
+    def _dead_letter(self, data, code, error):
+        """永久失败或重试次数用完：移出发送队列，转入死信"""
+        with self.pending_lock:
+            if self.pending_emails.pop(data.id, None) is None: return
+            self.dead_letters[data.id] = data
+            data.status = "失败"; data.error = error
+            self._persist(data)
+        self.attach_cache.release(data.attachments)
+        self.metrics.inc("failed", code=str(code or "none"), account=data.sender)
+        self._log_history(data, f"失败: {error}")
+
+    def _failover(self, batch, reason, suspend_for):
+        """暂停当前账号，把按策略分配的邮件改派给其他可用账号并立即重新排队；返回无法改派的邮件"""
+        sender = batch[0].sender
+        self.accounts.suspend(sender, suspend_for, reason)
+        rest = []
+        for d in batch:
+            acct = d.strategy and self.accounts.pick(d.email, d.strategy, exclude={sender})
+            if not acct:
+                rest.append(d); continue
+            with self.pending_lock: d.account = (acct["email"], acct["pwd"], acct["smtp"])
+            self.metrics.inc("retries", reason="failover")
+            self._reschedule(d, 0)
+        return rest
+
+    def _mark_sent(self, data):
+        with self.pending_lock:
+            self.pending_emails.pop(data.id, None)
+            self._finished[data.id] = data
+            data.status = "已发送"
+            self._persist(data)
+        self.attach_cache.release(data.attachments)
+        self._log_history(data, "成功")
+
+    def _log_history(self, data, status):
+        self.history_writer.put((data.name, data.email, data.subject, datetime.datetime.now(), status))
+
+    def _write_history(self, rows):
+        with self.metrics.span("history"): self.db.log_history_many(rows)
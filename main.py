@@ -1,24 +1,16 @@
+import time
+_STARTUP_T0 = time.perf_counter()  # 启动计时从导入模块之前开始
 import tkinter as tk
-from tkinter import ttk, messagebox, scrolledtext, filedialog, colorchooser
-from PIL import Image, ImageTk
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email import encoders
+from tkinter import ttk, messagebox, scrolledtext, filedialog, colorchooser, simpledialog
 import sqlite3
 import os
 import threading
 import queue
-import time
 import datetime
-
-# 尝试导入openpyxl
-try:
-    import openpyxl
-    EXCEL_SUPPORT = True
-except ImportError:
-    EXCEL_SUPPORT = False
+import json
+import hashlib
+from db import Database, history_where
+from engine import MailEngine, AccountRouter, import_contacts, valid_email, EXCEL_SUPPORT
 
 # ==========================================
 # 核心UI组件库 - Liquid Glass 风格
@@ -51,7 +43,49 @@ class ModernTheme:
         "icon": ("Segoe UI Emoji", 28)
     }
 
-class ShadowElement(tk.Canvas):
+class RedrawCanvas(tk.Canvas):
+    """自绘控件基类：<Configure> 和状态变化只登记重绘，同一空闲周期内合并成一次；
+    尺寸和状态都没变时跳过；图形只在第一次绘制时创建，之后用 coords/itemconfigure 原地更新"""
+    def __init__(self, parent, **kwargs):
+        super().__init__(parent, **kwargs)
+        self._redraw_pending = False
+        self._drawn = None   # 上次绘制时的 (宽, 高, 状态)
+        self._items = {}
+        self.bind("<Configure>", self.request_redraw)
+
+    def request_redraw(self, event=None):
+        if self._redraw_pending: return
+        self._redraw_pending = True
+        self.after_idle(self._redraw)
+
+    def _redraw(self):
+        self._redraw_pending = False
+        try: w, h = self.winfo_width(), self.winfo_height()
+        except tk.TclError: return  # 控件已销毁
+        key = (w, h, self._state())
+        if key == self._drawn: return
+        self._drawn = key
+        self._draw(w, h)
+
+    def _state(self):
+        """影响外观的状态，子类按需覆盖"""
+        return None
+
+    def _item(self, name, kind, coords, **opts):
+        """创建或原地更新名为 name 的图形"""
+        iid = self._items.get(name)
+        if iid is None:
+            iid = self._items[name] = getattr(self, "create_" + kind)(*coords, **opts)
+        else:
+            self.coords(iid, *coords)
+            if opts: self.itemconfigure(iid, **opts)
+        return iid
+
+    @staticmethod
+    def _rounded_rect(x1, y1, x2, y2, r):
+        return (x1+r, y1, x1+r, y1, x2-r, y1, x2-r, y1, x2, y1, x2, y1+r, x2, y1+r, x2, y2-r, x2, y2-r, x2, y2, x2-r, y2, x2-r, y2, x1+r, y2, x1+r, y2, x1, y2, x1, y2-r, x1, y2-r, x1, y1+r, x1, y1+r, x1, y1)
+
+class ShadowElement(RedrawCanvas):
     """用于绘制带有柔和阴影的圆角容器"""
     def __init__(self, parent, radius=15, color="#ffffff", padding=15, **kwargs):
         super().__init__(parent, highlightthickness=0, bg=ModernTheme.COLORS["bg_app"], **kwargs)
@@ -59,28 +93,20 @@ class ShadowElement(tk.Canvas):
         self.color = color
         self.padding = padding
         self.inner_frame = tk.Frame(self, bg=color)
-        self.bind("<Configure>", self._draw)
 
-    def _draw(self, event=None):
-        self.delete("all")
-        w, h = self.winfo_width(), self.winfo_height()
-        
+    def _draw(self, w, h):
         # 绘制多层阴影
-        self._create_rounded_rect(2, 4, w-2, h-2, self.radius, fill="#e5e7eb", outline="")
-        self._create_rounded_rect(1, 2, w-3, h-3, self.radius, fill="#d1d5db", outline="")
+        self._item("shadow1", "polygon", self._rounded_rect(2, 4, w-2, h-2, self.radius), fill="#e5e7eb", outline="", smooth=True)
+        self._item("shadow2", "polygon", self._rounded_rect(1, 2, w-3, h-3, self.radius), fill="#d1d5db", outline="", smooth=True)
         
         # 主体
-        self._create_rounded_rect(0, 0, w-5, h-5, self.radius, fill=self.color, outline=ModernTheme.COLORS["card_border"])
+        self._item("body", "polygon", self._rounded_rect(0, 0, w-5, h-5, self.radius), fill=self.color, outline=ModernTheme.COLORS["card_border"], smooth=True)
         
         # 放置内容容器
-        self.create_window(self.padding, self.padding, window=self.inner_frame, 
-                         anchor="nw", width=w-5-(self.padding*2), height=h-5-(self.padding*2))
-
-    def _create_rounded_rect(self, x1, y1, x2, y2, r, **kwargs):
-        points = (x1+r, y1, x1+r, y1, x2-r, y1, x2-r, y1, x2, y1, x2, y1+r, x2, y1+r, x2, y2-r, x2, y2-r, x2, y2, x2-r, y2, x2-r, y2, x1+r, y2, x1+r, y2, x1, y2, x1, y2-r, x1, y2-r, x1, y1+r, x1, y1+r, x1, y1)
-        return self.create_polygon(points, **kwargs, smooth=True)
+        self._item("inner", "window", (self.padding, self.padding), window=self.inner_frame,
+                   anchor="nw", width=w-5-(self.padding*2), height=h-5-(self.padding*2))
 
-class CapsuleButton(tk.Canvas):
+class CapsuleButton(RedrawCanvas):
     """胶囊形状的按钮"""
     def __init__(self, parent, text, command, bg_color=ModernTheme.COLORS["primary"], text_color="white", width=100, height=105):
         super().__init__(parent, width=width, height=height, bg=parent["bg"], highlightthickness=0)
@@ -91,19 +117,15 @@ class CapsuleButton(tk.Canvas):
         self.hover_color = bg_color # 简单起见，暂不处理复杂变色
         
         self.bind("<Button-1>", lambda e: self.command())
-        self.bind("<Configure>", self._draw)
 
-    def _draw(self, event=None):
-        self.delete("all")
-        w, h = self.winfo_width(), self.winfo_height()
-        
-        self.create_oval(0, 0, h, h, fill=self.bg_color, outline="")
-        self.create_oval(w-h, 0, w, h, fill=self.bg_color, outline="")
-        self.create_rectangle(h/2, 0, w-h/2, h, fill=self.bg_color, outline="")
+    def _draw(self, w, h):
+        self._item("left", "oval", (0, 0, h, h), fill=self.bg_color, outline="")
+        self._item("right", "oval", (w-h, 0, w, h), fill=self.bg_color, outline="")
+        self._item("middle", "rectangle", (h/2, 0, w-h/2, h), fill=self.bg_color, outline="")
         
-        self.create_text(w/2, h/2, text=self.text, fill=self.text_color, font=("Microsoft YaHei", 30, "bold"))
+        self._item("text", "text", (w/2, h/2), text=self.text, fill=self.text_color, font=("Microsoft YaHei", 30, "bold"))
 
-class SidebarButton(tk.Canvas):
+class SidebarButton(RedrawCanvas):
     """侧边栏导航按钮"""
     def __init__(self, parent, text, icon, command, is_selected=False):
         super().__init__(parent, height=165, bg=ModernTheme.COLORS["sidebar_bg"], highlightthickness=0)
@@ -116,38 +138,39 @@ class SidebarButton(tk.Canvas):
         self.bind("<Enter>", self._on_enter)
         self.bind("<Leave>", self._on_leave)
         self.bind("<Button-1>", lambda e: command())
-        self.bind("<Configure>", self._draw)
 
     def set_selected(self, val):
+        if val == self.is_selected: return
         self.is_selected = val
-        self._draw()
+        self.request_redraw()
 
     def _on_enter(self, e):
         self.hovering = True
-        self._draw()
+        self.request_redraw()
 
     def _on_leave(self, e):
         self.hovering = False
-        self._draw()
+        self.request_redraw()
 
-    def _draw(self, event=None):
-        self.delete("all")
-        w, h = self.winfo_width(), self.winfo_height()
-        
+    def _state(self):
+        return (self.is_selected, self.hovering)
+
+    def _draw(self, w, h):
         bg = ModernTheme.COLORS["primary_light"] if self.is_selected else (ModernTheme.COLORS["bg_app"] if self.hovering else ModernTheme.COLORS["sidebar_bg"])
         fg = ModernTheme.COLORS["primary"] if self.is_selected else ModernTheme.COLORS["text_sub"]
         
-        if self.is_selected:
-            self.create_polygon(10, 5, w-10, 5, w-10, h-5, 10, h-5, smooth=True, fill=bg, outline="")
-            self.create_line(10, 15, 10, h-15, width=4, fill=ModernTheme.COLORS["primary"], capstyle=tk.ROUND)
-        elif self.hovering:
-             self.create_polygon(15, 8, w-15, 8, w-15, h-8, 15, h-8, smooth=True, fill=bg, outline="")
+        # 选中和悬停的背景都预先建好，按状态显示或隐藏
+        sel = "normal" if self.is_selected else "hidden"
+        hover = "normal" if self.hovering and not self.is_selected else "hidden"
+        self._item("sel_bg", "polygon", (10, 5, w-10, 5, w-10, h-5, 10, h-5), smooth=True, fill=bg, outline="", state=sel)
+        self._item("sel_bar", "line", (10, 15, 10, h-15), width=4, fill=ModernTheme.COLORS["primary"], capstyle=tk.ROUND, state=sel)
+        self._item("hover_bg", "polygon", (15, 8, w-15, 8, w-15, h-8, 15, h-8), smooth=True, fill=bg, outline="", state=hover)
 
         font_size = 66 if self.is_selected else 60
         icon_size = 105 if self.is_selected else 72
         
-        self.create_text(135, h/2, text=self.icon, font=("Segoe UI Emoji", icon_size), fill=fg, anchor="center")
-        self.create_text(225, h/2, text=self.text, font=("Microsoft YaHei", font_size, "bold" if self.is_selected else "normal"), fill=fg, anchor="w")
+        self._item("icon", "text", (135, h/2), text=self.icon, font=("Segoe UI Emoji", icon_size), fill=fg, anchor="center")
+        self._item("label", "text", (225, h/2), text=self.text, font=("Microsoft YaHei", font_size, "bold" if self.is_selected else "normal"), fill=fg, anchor="w")
 
 class ModernEntry(tk.Entry):
     """美化输入框"""
@@ -220,12 +243,257 @@ class EditorToolbar(tk.Frame):
             self.text_widget.tag_configure(tag_name, foreground=c)
             self.text_widget.tag_add(tag_name, "sel.first", "sel.last")
 
+# ==========================================
+# 按需分页加载的表格
+# ==========================================
+
+class LazyTreeLoader:
+    """为 Treeview 按需加载数据：滚动接近底部/顶部时用键集分页 (keyset) 取下一页/上一页，
+    控件中只保留可见区域附近的 max_rows 行；点击表头时在 SQL 中排序。
+    columns 为与表格列一一对应的 SQL 表达式，key 为唯一键 (用作行 iid 和排序的第二关键字)。"""
+    def __init__(self, tree, db, source, key, columns, sort_exprs=None, sort_col=None, desc=False,
+                 page_size=200, max_rows=1000, scrollbar=None):
+        self.tree = tree
+        self.db = db
+        self.source = source
+        self.key = key
+        self.columns = columns
+        self.sort_exprs = sort_exprs or {}
+        self.sort_col = sort_col
+        self.desc = desc
+        self.page_size = page_size
+        self.max_rows = max_rows
+        self.scrollbar = scrollbar
+        self.where, self.params = "1", ()
+        self.active = False
+        self.at_start = self.at_end = True
+        self._anchors = {}  # iid -> (排序值, 键)
+        self._busy = False
+        self._titles = {c: tree.heading(c, "text") for c in tree["columns"]}
+        for c in tree["columns"]: tree.heading(c, command=lambda c=c: self.sort_by(c))
+        tree.configure(yscrollcommand=self._on_scroll)
+        if scrollbar is not None: scrollbar.configure(command=tree.yview)
+
+    def _sort_expr(self):
+        return self.sort_exprs.get(self.sort_col, self.key)
+
+    def set_filter(self, where="1", params=()):
+        self.where, self.params = where, tuple(params)
+
+    def sort_by(self, col):
+        if col not in self.sort_exprs: return
+        self.desc = (not self.desc) if col == self.sort_col else False
+        self.sort_col = col
+        for c, title in self._titles.items():
+            self.tree.heading(c, text=title + ((" ▼" if self.desc else " ▲") if c == col else ""))
+        self.reset()
+
+    def reset(self):
+        self.active = True
+        self.tree.delete(*self.tree.get_children())
+        self._anchors.clear()
+        self.at_start, self.at_end = True, False
+        self._load(forward=True)
+
+    def suspend(self):
+        """表格暂时用于显示其他内容 (如搜索结果) 时停止按需加载"""
+        self.active = False
+
+    def _fetch(self, forward, anchor):
+        sort = self._sort_expr()
+        ascending = forward != self.desc
+        op, order = (">", "ASC") if ascending else ("<", "DESC")
+        cond = f"({sort}, {self.key}) {op} (?, ?)" if anchor else "1"
+        sql = (f"SELECT {sort}, {self.key}, {', '.join(self.columns)} FROM {self.source} "
+               f"WHERE ({self.where}) AND {cond} ORDER BY {sort} {order}, {self.key} {order} LIMIT ?")
+        return self.db.query(sql, self.params + (tuple(anchor) if anchor else ()) + (self.page_size,))
+
+    def _load(self, forward):
+        tree = self.tree
+        children = tree.get_children()
+        if forward: anchor = self._anchors.get(children[-1]) if children else None
+        else: anchor = self._anchors.get(children[0]) if children else None
+        rows = self._fetch(forward, anchor)
+        for r in rows:
+            iid = str(r[1])
+            if tree.exists(iid): continue
+            self._anchors[iid] = (r[0], r[1])
+            tree.insert("", tk.END if forward else 0, iid=iid, values=r[2:])
+        if len(rows) < self.page_size:
+            if forward: self.at_end = True
+            else: self.at_start = True
+        # 超出窗口的行从另一头移除
+        children = tree.get_children()
+        extra = len(children) - self.max_rows
+        if extra > 0:
+            drop = children[:extra] if forward else children[-extra:]
+            tree.delete(*drop)
+            for iid in drop: self._anchors.pop(iid, None)
+            if forward: self.at_start = False
+            else: self.at_end = False
+        return len(rows)
+
+    def _first_visible(self):
+        return next((i for i in (self.tree.identify_row(y) for y in range(0, 80, 8)) if i), "")
+
+    def _extend(self, forward):
+        try:
+            top = self._first_visible()
+            self._load(forward)
+            # 前后增删行之后，保持原来看到的那一行仍在视野顶部
+            if top and self.tree.exists(top):
+                total = len(self.tree.get_children())
+                self.tree.yview_moveto(self.tree.index(top) / max(total, 1))
+        finally:
+            self._busy = False
+
+    def _on_scroll(self, first, last):
+        if self.scrollbar is not None: self.scrollbar.set(first, last)
+        if not self.active or self._busy: return
+        if float(last) >= 0.95 and not self.at_end: forward = True
+        elif float(first) <= 0.05 and not self.at_start: forward = False
+        else: return
+        self._busy = True
+        self.tree.after_idle(lambda: self._extend(forward))
+
+# ==========================================
+# 搜索框防抖
+# ==========================================
+
+class DebouncedSearch:
+    """边输入边搜索：停止输入 delay 毫秒后才在后台线程查询，新的查询会中断并作废尚未返回的旧查询。
+    on_results(rows, offset, has_more) 在 Tk 主线程回调；结果按相关度排序、分页返回。
+    查询由一个常驻的后台线程复用同一条连接执行，空闲 IDLE_EXIT 秒后线程退出并关闭连接。"""
+    IDLE_EXIT = 30
+
+    def __init__(self, entry, db, on_results, fields="c.id, c.name, c.email, c.title, c.department", page_size=200, delay=250, on_empty=None):
+        self.entry = entry
+        self.db = db
+        self.on_results = on_results
+        self.on_empty = on_empty  # 搜索框为空时调用 (通常切回按需加载的完整列表)
+        self.fields = fields
+        self.page_size = page_size
+        self.delay = delay
+        self._after = None
+        self._gen = 0
+        self._inflight = None
+        self._requests = queue.Queue()
+        self._results = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._polling = False
+        entry.bind("<KeyRelease>", self._on_key, add="+")
+        entry.bind("<Return>", lambda e: self.run(), add="+")
+
+    def _on_key(self, e=None):
+        if e is not None and e.keysym == "Return": return
+        if self._after: self.entry.after_cancel(self._after)
+        self._after = self.entry.after(self.delay, self.run)
+
+    def run(self, offset=0):
+        if self._after: self.entry.after_cancel(self._after)
+        self._after = None
+        self._gen += 1
+        stale = self._inflight
+        if stale is not None:
+            try: stale.interrupt()
+            except Exception: pass
+        if self.on_empty and not self.entry.get().strip():
+            return self.on_empty()
+        with self._worker_lock:
+            self._requests.put((self._gen, self.entry.get(), offset))
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work, daemon=True)
+                self._worker.start()
+        if not self._polling:
+            self._polling = True
+            self.entry.after(20, self._poll)
+
+    def _work(self):
+        while True:
+            try: gen, query, offset = self._requests.get(timeout=self.IDLE_EXIT)
+            except queue.Empty:
+                with self._worker_lock:
+                    if self._requests.empty():
+                        self._worker = None
+                        self.db.release(); return
+                continue
+            if gen != self._gen: continue  # 已有更新的查询排在后面
+            self._inflight = self.db.conn()
+            try: rows = self.db.search_contacts(query, self.fields, self.page_size + 1, offset)
+            except sqlite3.OperationalError: rows = None  # 被新的查询中断
+            finally: self._inflight = None
+            self._results.put((gen, offset, rows))
+
+    def _poll(self):
+        try:
+            while True:
+                gen, offset, rows = self._results.get_nowait()
+                if gen == self._gen and rows is not None:
+                    self._polling = False
+                    return self.on_results(rows[:self.page_size], offset, len(rows) > self.page_size)
+        except queue.Empty: pass
+        except tk.TclError:  # 窗口已关闭
+            self._polling = False; return
+        self.entry.after(20, self._poll)
+
+# ==========================================
+# 启动加速
+# ==========================================
+
+class StartupTimer:
+    """记录启动各阶段耗时。环境变量 AUTOEMAIL_STARTUP_TIMING=1 时在窗口首次绘制后打印到控制台，
+    设为文件路径时按 JSON 行追加到该文件，便于比较不同版本的启动时间"""
+    def __init__(self, t0):
+        self.target = os.environ.get("AUTOEMAIL_STARTUP_TIMING")
+        self.t0 = self.last = t0
+        self.marks = []
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.marks.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        if not self.target: return
+        self.mark("首次绘制")
+        total = self.last - self.t0
+        if self.target == "1":
+            for name, sec in self.marks: print(f"{name:<8} {sec * 1000:8.1f} ms")
+            print(f"{'合计':<8} {total * 1000:8.1f} ms")
+        else:
+            with open(self.target, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"at": datetime.datetime.now().isoformat(timespec="seconds"), "total_ms": round(total * 1000, 1),
+                                    "phases": {n: round(s * 1000, 1) for n, s in self.marks}}, ensure_ascii=False) + "\n")
+
+def cache_dir():
+    base = os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "AutoEmail")
+
+def load_icon(path, size):
+    """侧边栏图标：缩放后的 PNG 按原图内容缓存在用户缓存目录，之后启动直接由 Tk 读取，不必导入 PIL 重新缩放"""
+    with open(path, 'rb') as f: digest = hashlib.md5(f.read()).hexdigest()[:16]
+    cached = os.path.join(cache_dir(), f"icon_{size}_{digest}.png")
+    if not os.path.exists(cached):
+        from PIL import Image
+        img = Image.open(path).resize((size, size), Image.Resampling.LANCZOS)
+        try:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            tmp = cached + f".{os.getpid()}.tmp"
+            img.save(tmp, "PNG"); os.replace(tmp, cached)
+        except OSError:  # 缓存目录不可写时直接使用缩放结果
+            from PIL import ImageTk
+            return ImageTk.PhotoImage(img)
+    return tk.PhotoImage(file=cached)
+
 # ==========================================
 # 主程序逻辑
 # ==========================================
 
 class EmailSender:
     def __init__(self, root):
+        self.startup = StartupTimer(_STARTUP_T0)
+        self.startup.mark("导入模块")
         self.root = root
         self.root.title("AutoEmail v4.0")
         self.root.geometry("1300x900")
@@ -237,16 +505,32 @@ class EmailSender:
         except: pass
 
         self.setup_ttk_styles()
+        self.startup.mark("窗口样式")
         
         self.db_path = os.path.join(os.path.dirname(__file__), 'email_data.db')
         self.attachment_files = []
-        self.send_queue = queue.Queue()
-        self.pending_emails = {}
+        self._queue_refresh_pending = False
+        self._countdown_at = 0
+        self._adopt_at = time.time()  # 启动时已恢复队列，之后定时接管其他进程留下的邮件
         
-        self.init_db()
+        self.db = Database(self.db_path)
+        self.db.init_schema()
+        self.startup.mark("数据库")
+        self.engine = MailEngine(self.db)
+        self.startup.mark("发送引擎")
         self.create_layout()
+        self.startup.mark("界面")
         self.load_config()
         self.start_queue_worker()
+        self.engine.apply_history_retention()
+        self.startup.mark("恢复队列")
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after_idle(lambda: self.root.after(0, self.startup.report))
+
+    def on_close(self):
+        self.engine.shutdown()
+        self.db.close()
+        self.root.destroy()
 
     def setup_ttk_styles(self):
         style = ttk.Style()
@@ -260,16 +544,6 @@ class EmailSender:
         style.map("Treeview", background=[('selected', ModernTheme.COLORS["primary_light"])], foreground=[('selected', ModernTheme.COLORS["primary"])])
         style.configure("Vertical.TScrollbar", troughcolor="#f3f4f6", background="#d1d5db", borderwidth=0, arrowsize=12)
 
-    def init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('CREATE TABLE IF NOT EXISTS contacts (id INTEGER PRIMARY KEY, name TEXT, email TEXT, title TEXT, department TEXT)')
-        c.execute('CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY, recipient_name TEXT, recipient_email TEXT, subject TEXT, sent_at TIMESTAMP, status TEXT)')
-        c.execute('CREATE TABLE IF NOT EXISTS config (key TEXT UNIQUE, value TEXT)')
-        c.execute('CREATE TABLE IF NOT EXISTS templates (id INTEGER PRIMARY KEY, name TEXT, subject TEXT, content TEXT)')
-        conn.commit()
-        conn.close()
-
     def create_layout(self):
         self.sidebar = tk.Frame(self.root, bg=ModernTheme.COLORS["sidebar_bg"], width=240)
         self.sidebar.pack(side=tk.LEFT, fill=tk.Y)
@@ -279,9 +553,7 @@ class EmailSender:
         icon_path = os.path.join(os.path.dirname(__file__), 'icon.png')
         if os.path.exists(icon_path):
             try:
-                icon_image = Image.open(icon_path)
-                icon_image = icon_image.resize((60, 60), Image.Resampling.LANCZOS)
-                icon_photo = ImageTk.PhotoImage(icon_image)
+                icon_photo = load_icon(icon_path, 60)
                 icon_label = tk.Label(self.sidebar, image=icon_photo, 
                                      bg=ModernTheme.COLORS["sidebar_bg"])
                 icon_label.image = icon_photo  # 保持引用防止被垃圾回收
@@ -294,6 +566,7 @@ class EmailSender:
         
         self.nav_btns = {}
         self.pages = {}
+        self._built = set()  # 已经构建过的页面，其余页面在第一次打开时才构建
         self.content_area = tk.Frame(self.root, bg=ModernTheme.COLORS["bg_app"])
         self.content_area.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
         
@@ -305,14 +578,15 @@ class EmailSender:
             btn.pack(fill=tk.X, pady=4, padx=8)
             self.nav_btns[key] = btn
             
-            frame = tk.Frame(self.content_area, bg=ModernTheme.COLORS["bg_app"])
-            self.pages[key] = frame
-            getattr(self, f"ui_{key}")(frame)
+            self.pages[key] = tk.Frame(self.content_area, bg=ModernTheme.COLORS["bg_app"])
 
         tk.Label(self.sidebar, text="v4.0 Ultimate", fg="#9ca3af", bg="white").pack(side=tk.BOTTOM, pady=10)
         self.switch_page("send")
 
     def switch_page(self, key):
+        if key not in self._built:
+            self._built.add(key)
+            getattr(self, f"ui_{key}")(self.pages[key])
         for k, btn in self.nav_btns.items():
             btn.set_selected(k == key)
         for k, frame in self.pages.items():
@@ -360,12 +634,22 @@ class EmailSender:
         c_inner = card_conf.inner_frame
         
         tk.Label(c_inner, text="⚙️ 发件配置", font=ModernTheme.FONTS["h3"], bg="white", fg=ModernTheme.COLORS["primary"]).pack(anchor="w", pady=(0, 10))
+        # 已保存的发件账号：选中后填入下面的输入框，保存配置即新增或更新账号
+        acct_row = tk.Frame(c_inner, bg="white"); acct_row.pack(fill=tk.X, pady=(0, 8))
+        self.combo_account = ttk.Combobox(acct_row, state="readonly")
+        self.combo_account.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.combo_account.bind("<<ComboboxSelected>>", lambda e: self.load_account(self.combo_account.get()))
+        tk.Button(acct_row, text="删除", command=self.delete_account, relief="flat", fg="red", bg="white").pack(side=tk.RIGHT)
         tk.Label(c_inner, text="邮箱:", bg="white", font=ModernTheme.FONTS["body"]).pack(anchor="w")
         self.entry_email = ModernEntry(c_inner, font=("Microsoft YaHei", 25)); self.entry_email.pack(fill=tk.X, pady=(0, 8))
         tk.Label(c_inner, text="授权码:", bg="white", font=ModernTheme.FONTS["body"]).pack(anchor="w")
         self.entry_pwd = ModernEntry(c_inner, show="*", font=("Microsoft YaHei", 25)); self.entry_pwd.pack(fill=tk.X, pady=(0, 8))
         tk.Label(c_inner, text="SMTP:", bg="white", font=ModernTheme.FONTS["body"]).pack(anchor="w")
-        self.entry_smtp = ModernEntry(c_inner, font=("Microsoft YaHei", 25)); self.entry_smtp.pack(fill=tk.X, pady=(0, 10))
+        self.entry_smtp = ModernEntry(c_inner, font=("Microsoft YaHei", 25)); self.entry_smtp.pack(fill=tk.X, pady=(0, 8))
+        tk.Label(c_inner, text="限额 (每分钟 / 每日，留空不限):", bg="white", font=ModernTheme.FONTS["body"]).pack(anchor="w")
+        quota_row = tk.Frame(c_inner, bg="white"); quota_row.pack(fill=tk.X, pady=(0, 10))
+        self.entry_per_minute = ModernEntry(quota_row, width=6, font=("Microsoft YaHei", 25)); self.entry_per_minute.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 4))
+        self.entry_per_day = ModernEntry(quota_row, width=6, font=("Microsoft YaHei", 25)); self.entry_per_day.pack(side=tk.LEFT, fill=tk.X, expand=True)
         CapsuleButton(c_inner, text="保存配置", width=300, height=40, command=self.save_config).pack()
 
         # 附件
@@ -403,6 +687,10 @@ class EmailSender:
         tk.Button(ac_inner, text="清空列表", command=lambda: self.list_rcpt.delete(0, tk.END), relief="flat", fg="red", bg="white", font=("Microsoft YaHei", 30)).pack(anchor="e")
         
         CapsuleButton(ac_inner, text="🚀 加入发送队列", width=300, height=45, command=self.add_to_queue).pack(side=tk.BOTTOM, pady=10)
+        route_row = tk.Frame(ac_inner, bg="white"); route_row.pack(side=tk.BOTTOM, fill=tk.X)
+        tk.Label(route_row, text="发件账号:", bg="white", font=ModernTheme.FONTS["body"]).pack(side=tk.LEFT)
+        self.combo_route = ttk.Combobox(route_row, state="readonly", values=["仅当前账号"] + [f"全部账号 ({v})" for v in AccountRouter.STRATEGIES.values()])
+        self.combo_route.set("仅当前账号"); self.combo_route.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
 
     def ui_queue(self, parent):
         card = ShadowElement(parent, radius=15)
@@ -413,10 +701,24 @@ class EmailSender:
         tk.Label(top, text="发送队列 (30s 缓冲)", font=ModernTheme.FONTS["h1"], bg="white").pack(side=tk.LEFT)
         tk.Button(top, text="⚡ 立即发送", command=self.force_send_all, bg=ModernTheme.COLORS["success"], fg="white", relief="flat", padx=45, font=("Microsoft YaHei", 30)).pack(side=tk.RIGHT, padx=5)
         tk.Button(top, text="↩️ 撤回", command=self.withdraw_email, bg=ModernTheme.COLORS["danger"], fg="white", relief="flat", padx=45, font=("Microsoft YaHei", 30)).pack(side=tk.RIGHT)
+        # 失败的邮件 (死信)：选中时只处理选中的，否则处理全部
+        tk.Button(top, text="清除失败", command=self.purge_failed, bg="#9ca3af", fg="white", relief="flat", font=("Microsoft YaHei", 30)).pack(side=tk.RIGHT, padx=5)
+        tk.Button(top, text="重试失败", command=self.requeue_failed, bg="#0ea5e9", fg="white", relief="flat", font=("Microsoft YaHei", 30)).pack(side=tk.RIGHT)
+        # 发送统计：成功/失败/重试数和各阶段平均耗时，随倒计时每秒刷新
+        self.lbl_queue_metrics = tk.Label(inner, text="", bg="white", fg=ModernTheme.COLORS["text_sub"], font=("Microsoft YaHei", 10), anchor="w")
+        self.lbl_queue_metrics.pack(fill=tk.X)
+        self.lbl_account_progress = tk.Label(inner, text="", bg="white", fg=ModernTheme.COLORS["text_sub"], font=("Microsoft YaHei", 10), anchor="w", justify="left")
+        self.lbl_account_progress.pack(fill=tk.X, pady=(0, 5))
         
+        sb = ttk.Scrollbar(inner, orient=tk.VERTICAL, style="Vertical.TScrollbar")
+        sb.pack(side=tk.RIGHT, fill=tk.Y)
         self.tree_queue = ttk.Treeview(inner, columns=("ID", "收件人", "邮箱", "倒计时", "状态"), show="headings")
         for c in ("ID", "收件人", "邮箱", "倒计时", "状态"): self.tree_queue.heading(c, text=c)
+        # 滚动后新露出来的行需要刷新倒计时
+        self.tree_queue.configure(yscrollcommand=lambda *a: (sb.set(*a), self.request_queue_refresh()))
+        sb.configure(command=self.tree_queue.yview)
         self.tree_queue.pack(fill=tk.BOTH, expand=True)
+        self.refresh_queue_ui(full=True)
 
     def ui_contacts(self, parent):
         card = ShadowElement(parent, radius=15)
@@ -426,14 +728,25 @@ class EmailSender:
         bar = tk.Frame(inner, bg="white"); bar.pack(fill=tk.X, pady=10)
         self.entry_search = ModernEntry(bar, width=30, font=("Microsoft YaHei", 25)); self.entry_search.pack(side=tk.LEFT, padx=5)
         tk.Button(bar, text="搜索", command=self.search_contacts, bg=ModernTheme.COLORS["primary"], fg="white", relief="flat", font=("Microsoft YaHei", 30)).pack(side=tk.LEFT)
+        self.contact_search = DebouncedSearch(self.entry_search, self.db, self._show_contact_results)
         
         tk.Button(bar, text="删除", command=self.delete_contact, bg="red", fg="white", relief="flat", font=("Microsoft YaHei", 30)).pack(side=tk.RIGHT, padx=5)
-        tk.Button(bar, text="导入Excel", command=self.import_excel, bg="#0ea5e9", fg="white", relief="flat", font=("Microsoft YaHei", 30)).pack(side=tk.RIGHT, padx=5)
+        tk.Button(bar, text="导入Excel/CSV", command=self.import_excel, bg="#0ea5e9", fg="white", relief="flat", font=("Microsoft YaHei", 30)).pack(side=tk.RIGHT, padx=5)
         tk.Button(bar, text="新建", command=self.add_contact_dialog, bg=ModernTheme.COLORS["success"], fg="white", relief="flat", font=("Microsoft YaHei", 30)).pack(side=tk.RIGHT)
         
+        self.btn_contacts_more = tk.Button(inner, text="加载更多", command=lambda: self.contact_search.run(self._contacts_shown),
+                                           relief="flat", bg="white", fg=ModernTheme.COLORS["primary"])
+        sb = ttk.Scrollbar(inner, orient=tk.VERTICAL, style="Vertical.TScrollbar"); sb.pack(side=tk.RIGHT, fill=tk.Y)
         self.tree_contacts = ttk.Treeview(inner, columns=("ID", "姓名", "邮箱", "职称", "院系"), show="headings")
         for c in ("ID", "姓名", "邮箱", "职称", "院系"): self.tree_contacts.heading(c, text=c)
         self.tree_contacts.pack(fill=tk.BOTH, expand=True)
+        self.contacts_loader = LazyTreeLoader(
+            self.tree_contacts, self.db, "contacts c", "c.id", ["c.id", "c.name", "c.email", "c.title", "c.department"],
+            sort_exprs={"ID": "c.id", "姓名": "COALESCE(c.name, '')", "邮箱": "COALESCE(c.email, '')",
+                        "职称": "COALESCE(c.title, '')", "院系": "COALESCE(c.department, '')"},
+            sort_col="ID", scrollbar=sb)
+        self.contact_search.on_empty = self.refresh_contacts
+        self._contacts_shown = 0
         self.refresh_contacts()
 
     def ui_templates(self, parent):
@@ -456,10 +769,29 @@ class EmailSender:
         card = ShadowElement(parent, radius=15)
         card.pack(fill=tk.BOTH, expand=True)
         inner = card.inner_frame
-        tk.Button(inner, text="清空历史", command=self.clear_history, bg="red", fg="white", relief="flat", font=("Microsoft YaHei", 30)).pack(anchor="e", pady=10)
+        bar = tk.Frame(inner, bg="white"); bar.pack(fill=tk.X, pady=10)
+        self.hist_filters = {}
+        for key, label, width in (("since", "从", 11), ("until", "到", 11), ("recipient", "收件人", 16)):
+            tk.Label(bar, text=label, bg="white", font=("Microsoft YaHei", 10)).pack(side=tk.LEFT, padx=(5, 2))
+            e = ModernEntry(bar, width=width, font=("Microsoft YaHei", 12)); e.pack(side=tk.LEFT)
+            e.bind("<Return>", lambda ev: self.refresh_history())
+            self.hist_filters[key] = e
+        self.combo_hist_status = ttk.Combobox(bar, values=["全部", "成功", "失败"], state="readonly", width=6)
+        self.combo_hist_status.set("全部"); self.combo_hist_status.pack(side=tk.LEFT, padx=5)
+        self.combo_hist_status.bind("<<ComboboxSelected>>", lambda ev: self.refresh_history())
+        tk.Button(bar, text="筛选", command=self.refresh_history, bg=ModernTheme.COLORS["primary"], fg="white", relief="flat", font=("Microsoft YaHei", 30)).pack(side=tk.LEFT)
+        tk.Button(bar, text="清空历史", command=self.clear_history, bg="red", fg="white", relief="flat", font=("Microsoft YaHei", 30)).pack(side=tk.RIGHT)
+        tk.Button(bar, text="归档旧记录", command=self.archive_history, bg="#0ea5e9", fg="white", relief="flat", font=("Microsoft YaHei", 30)).pack(side=tk.RIGHT, padx=5)
+        sb = ttk.Scrollbar(inner, orient=tk.VERTICAL, style="Vertical.TScrollbar"); sb.pack(side=tk.RIGHT, fill=tk.Y)
         self.tree_hist = ttk.Treeview(inner, columns=("收件人", "邮箱", "主题", "时间", "状态"), show="headings")
         for c in ("收件人", "邮箱", "主题", "时间", "状态"): self.tree_hist.heading(c, text=c)
         self.tree_hist.pack(fill=tk.BOTH, expand=True)
+        self.history_loader = LazyTreeLoader(
+            self.tree_hist, self.db, "history h", "h.id",
+            ["h.recipient_name", "h.recipient_email", "h.subject", "h.sent_at", "h.status"],
+            sort_exprs={"收件人": "COALESCE(h.recipient_name, '')", "邮箱": "COALESCE(h.recipient_email, '')",
+                        "主题": "COALESCE(h.subject, '')", "时间": "h.sent_at", "状态": "COALESCE(h.status, '')"},
+            desc=True, scrollbar=sb)
         self.refresh_history()
 
     # ================= 功能逻辑 =================
@@ -478,24 +810,50 @@ class EmailSender:
             self.attachment_files.pop(index)
 
     def load_config(self):
-        conn = sqlite3.connect(self.db_path)
         try:
-            cfg = dict(conn.execute("SELECT key, value FROM config").fetchall())
-            if "email" in cfg: self.entry_email.insert(0, cfg["email"])
-            if "pwd" in cfg: self.entry_pwd.insert(0, cfg["pwd"])
-            if "smtp" in cfg: self.entry_smtp.insert(0, cfg["smtp"])
+            cfg = self.db.all_config()
+            self.refresh_account_combo()
+            self.load_account(cfg.get("email", ""), {"email": cfg.get("email", ""), "pwd": cfg.get("pwd", ""), "smtp": cfg.get("smtp", "")})
         except: pass
-        conn.close()
+
+    def refresh_account_combo(self):
+        self.combo_account['values'] = [a["email"] for a in self.db.list_accounts()]
+
+    def load_account(self, email, account=None):
+        """把账号 (默认从 accounts 表读取) 和它的限额填入发件配置"""
+        account = account or next((a for a in self.db.list_accounts() if a["email"] == email), None)
+        if not account: return
+        for entry, key in ((self.entry_email, "email"), (self.entry_pwd, "pwd"), (self.entry_smtp, "smtp")):
+            entry.delete(0, tk.END); entry.insert(0, account[key] or "")
+        per_minute, per_day = self.engine.rate_limiter.get_quota("account", email)
+        for entry, value in ((self.entry_per_minute, per_minute), (self.entry_per_day, per_day)):
+            entry.delete(0, tk.END)
+            if value: entry.insert(0, str(value))
+        self.combo_account.set(email)
+
+    def delete_account(self):
+        email = self.combo_account.get()
+        if not email or not messagebox.askyesno("确认", f"删除发件账号 {email}？"): return
+        self.db.delete_account(email)
+        self.refresh_account_combo(); self.combo_account.set("")
 
     def save_config(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.execute("DELETE FROM config")
-        conn.execute("INSERT INTO config VALUES (?,?)", ("email", self.entry_email.get()))
-        conn.execute("INSERT INTO config VALUES (?,?)", ("pwd", self.entry_pwd.get()))
-        conn.execute("INSERT INTO config VALUES (?,?)", ("smtp", self.entry_smtp.get()))
-        conn.commit(); conn.close()
+        # 只覆盖这三项，保留其他配置项 (如发送线程数)
+        self.db.set_config({"email": self.entry_email.get(), "pwd": self.entry_pwd.get(), "smtp": self.entry_smtp.get()})
+        try:
+            per_minute = int(self.entry_per_minute.get()) if self.entry_per_minute.get().strip() else None
+            per_day = int(self.entry_per_day.get()) if self.entry_per_day.get().strip() else None
+        except ValueError:
+            return messagebox.showwarning("提示", "限额必须是整数")
+        self.engine.rate_limiter.set_quota("account", self.entry_email.get(), per_minute, per_day)
+        # 当前配置同时保存为 accounts 表中的一个发件账号，供多账号分发使用
+        self.db.save_account(self.entry_email.get(), self.entry_pwd.get(), self.entry_smtp.get())
+        self.refresh_account_combo(); self.combo_account.set(self.entry_email.get())
         messagebox.showinfo("成功", "配置已保存")
 
+    def get_config(self, key, default=None):
+        return self.db.get_config(key, default)
+
     def add_to_queue(self):
         rcpts = self.list_rcpt.get(0, tk.END)
         if not rcpts: return messagebox.showwarning("提示", "收件人列表为空")
@@ -504,99 +862,119 @@ class EmailSender:
         body = self.txt_content.get("1.0", tk.END)
         sender = self.entry_email.get(); pwd = self.entry_pwd.get(); server = self.entry_smtp.get()
         
-        conn = sqlite3.connect(self.db_path)
-        send_time = time.time() + 30
-        count = 0
+        recipients = []
         for r_str in rcpts:
-            try:
-                name = r_str.split('<')[0].strip()
-                email = r_str.split('<')[1].strip('>')
-                res = conn.execute("SELECT title, department FROM contacts WHERE email=?", (email,)).fetchone()
-                title = res[0] if res else ""; dept = res[1] if res else ""
-                final_body = body.replace("{姓名}", name).replace("{职称}", title).replace("{院系}", dept)
-                eid = f"{int(time.time()*1000)}_{count}"
-                self.pending_emails[eid] = {
-                    "id": eid, "name": name, "email": email, "subject": subject, "content": final_body,
-                    "sender": sender, "pwd": pwd, "server": server, 
-                    "attachments": self.attachment_files.copy(),
-                    "send_at": send_time, "status": "等待中"
-                }
-                count += 1
-            except: pass
-        conn.close()
+            if '<' not in r_str: continue
+            recipients.append({"name": r_str.split('<')[0].strip(), "email": r_str.split('<')[1].strip('>')})
+        # "全部账号 (轮询)" 等选项按对应策略把收件人分给所有已保存的账号
+        route = self.combo_route.get()
+        strategy = next((k for k, v in AccountRouter.STRATEGIES.items() if v in route), None)
+        try:
+            entries = self.engine.enqueue(self.engine.render(recipients, subject, body, sender, pwd, server,
+                                                             self.attachment_files, send_at=time.time() + 30, strategy=strategy))
+        except ValueError as e:
+            return messagebox.showwarning("提示", str(e))
         self.refresh_queue_ui(); self.switch_page("queue")
-        messagebox.showinfo("成功", f"已添加 {count} 封邮件到队列")
+        messagebox.showinfo("成功", f"已添加 {len(entries)} 封邮件到队列")
 
     def start_queue_worker(self):
-        def worker():
-            while True:
-                time.sleep(1)
-                now = time.time()
-                to_send = []
-                for eid, data in self.pending_emails.items():
-                    if data["status"] == "等待中":
-                        rem = int(data["send_at"] - now)
-                        if rem <= 0: to_send.append(eid)
-                for eid in to_send:
-                    self.pending_emails[eid]["status"] = "发送中"
-                    self.send_queue.put(self.pending_emails[eid])
-                self.root.after(0, self.refresh_queue_ui)
-
-        def sender():
-            while True:
-                data = self.send_queue.get()
-                self._send_mail(data)
-                self.send_queue.task_done()
-
-        threading.Thread(target=worker, daemon=True).start()
-        threading.Thread(target=sender, daemon=True).start()
-
-    def _send_mail(self, data):
-        try:
-            msg = MIMEMultipart()
-            msg['From'] = data['sender']
-            msg['To'] = data['email']
-            msg['Subject'] = data['subject']
-            msg.attach(MIMEText(data['content'], 'plain', 'utf-8'))
-            for fpath in data['attachments']:
-                with open(fpath, 'rb') as f:
-                    part = MIMEBase('application', 'octet-stream'); part.set_payload(f.read())
-                encoders.encode_base64(part)
-                part.add_header('Content-Disposition', f'attachment; filename="{os.path.basename(fpath)}"')
-                msg.attach(part)
-            
-            if "qq.com" in data['server']: s = smtplib.SMTP_SSL(data['server'], 465)
-            elif "office365" in data['server']: s = smtplib.SMTP(data['server'], 587); s.starttls()
-            else: s = smtplib.SMTP_SSL(data['server'], 465)
-            s.login(data['sender'], data['pwd']); s.sendmail(data['sender'], data['email'], msg.as_string()); s.quit()
-            del self.pending_emails[data['id']]
-            self._log_history(data, "成功")
-        except Exception as e:
-            self.pending_emails[data['id']]["status"] = "失败"
-            self._log_history(data, f"失败: {e}")
-
-    def _log_history(self, data, status):
-        conn = sqlite3.connect(self.db_path)
-        conn.execute("INSERT INTO history (recipient_name, recipient_email, subject, sent_at, status) VALUES (?,?,?,?,?)",
-                    (data['name'], data['email'], data['subject'], datetime.datetime.now(), status))
-        conn.commit(); conn.close()
-
-    def refresh_queue_ui(self):
-        for i in self.tree_queue.get_children(): self.tree_queue.delete(i)
+        self.engine.start()
+        try: self.engine.export_metrics()  # 配置了 metrics_port / metrics_file 时导出 Prometheus 指标
+        except OSError as e: print(f"指标服务启动失败: {e}")
+        self._queue_ui_tick()
+
+    def _queue_ui_tick(self):
+        # 由 Tk 主线程轮询：发送线程只登记变化，不直接操作界面；倒计时每秒刷新一次
+        if self.engine.dirty or time.time() - self._countdown_at >= 1: self.refresh_queue_ui()
+        if time.time() - self._adopt_at >= 5:
+            self._adopt_at = float("inf")  # 上一次接管完成前不再发起
+            threading.Thread(target=self._adopt_waiting, daemon=True).start()
+        self.root.after(200, self._queue_ui_tick)
+
+    def _adopt_waiting(self):
+        """在后台线程中接管 send --no-wait 加入、或占用进程已退出的等待中邮件，界面由 dirty 轮询刷新"""
+        try: self.engine.adopt(self.engine.queue_store.load_waiting(exclude=self.engine.pending_emails))
+        except Exception as e: print(f"接管队列失败: {e}")
+        finally: self.db.release(); self._adopt_at = time.time()
+
+    def request_queue_refresh(self):
+        """同一帧内的多次刷新请求合并为一次重绘 (仅限 Tk 主线程调用)"""
+        if self._queue_refresh_pending: return
+        self._queue_refresh_pending = True
+        self.root.after(16, self.refresh_queue_ui)
+
+    def refresh_queue_ui(self, full=False):
+        """增量同步队列表格：只处理状态变化过的行，倒计时只更新可见区域；full 为 True 时同步全部邮件"""
+        self._queue_refresh_pending = False
+        if "queue" not in self._built:
+            self.engine.take_changes()  # 页面还没打开过：丢弃变化，避免越积越多，构建页面时整表同步
+            return
         now = time.time()
-        for eid, d in self.pending_emails.items():
-            rem = max(0, int(d["send_at"] - now)) if d["status"] == "等待中" else "-"
-            self.tree_queue.insert("", tk.END, values=(eid, d["name"], d["email"], f"{rem}s", d["status"]))
+        changes = self.engine.take_changes(full)
+        tree = self.tree_queue
+        for eid, snap in changes:
+            if snap is None or snap[2] == "已发送":  # 撤回或已发送的邮件移出队列
+                if tree.exists(eid): tree.delete(eid)
+                continue
+            name, email, status, send_at, error = snap
+            rem = max(0, int(send_at - now)) if status == "等待中" else "-"
+            if error and status == "等待中": status = "等待重试"
+            elif error and status == "失败": status = f"失败: {error}"
+            values = (eid, name, email, f"{rem}s", status)
+            if tree.exists(eid): tree.item(eid, values=values)
+            else: tree.insert("", tk.END, iid=eid, values=values)
+        self._update_visible_countdowns(now)
+        self._update_metrics_panel()
+        self._countdown_at = now
+
+    def _update_metrics_panel(self):
+        m = self.engine.metrics
+        text = f"已发送 {m.total('sent')} · 失败 {m.total('failed')} · 重试 {m.total('retries')}"
+        stages = m.summary()
+        if stages:
+            text += "  |  平均耗时 " + " · ".join(f"{label} {stages[k][1] * 1000:.0f}ms" for k, label in m.STAGES.items() if k in stages)
+        if self.lbl_queue_metrics.cget("text") != text: self.lbl_queue_metrics.config(text=text)
+        # 各发件账号的进度，只有一个账号时不显示
+        progress = self.engine.account_progress()
+        text = "\n".join(f"{email}: 已发送 {sent} · 待发送 {waiting} · 失败 {failed}" + (f" (暂停: {paused})" if paused else "")
+                         for email, (sent, waiting, failed, paused) in sorted(progress.items())) if len(progress) > 1 else ""
+        if self.lbl_account_progress.cget("text") != text: self.lbl_account_progress.config(text=text)
+
+    def _update_visible_countdowns(self, now):
+        tree = self.tree_queue
+        item = next((i for i in (tree.identify_row(y) for y in range(0, 80, 8)) if i), "")
+        while item and tree.bbox(item):
+            d = self.engine.pending_emails.get(item)
+            if d and d.status == "等待中":
+                rem = f"{max(0, int(d.send_at - now))}s"
+                if tree.set(item, "倒计时") != rem: tree.set(item, "倒计时", rem)
+            item = tree.next(item)
 
     def force_send_all(self):
-        for eid in self.pending_emails:
-            if self.pending_emails[eid]["status"] == "等待中": self.pending_emails[eid]["send_at"] = time.time()
+        self.engine.send_all_now()
+
+    def _failed_targets(self, action):
+        """选中的失败邮件，没有选中时为全部失败邮件；确认后返回 id 列表，取消时返回空列表"""
+        dead = self.engine.dead_letters
+        ids = [i for i in self.tree_queue.selection() if i in dead]
+        scope = "选中的" if ids else "全部"
+        ids = ids or list(dead)
+        if not ids: messagebox.showinfo("提示", "没有失败的邮件"); return []
+        return ids if messagebox.askyesno("确认", f"{action}{scope} {len(ids)} 封失败的邮件？") else []
+
+    def requeue_failed(self):
+        ids = self._failed_targets("重新发送")
+        if ids: self.engine.requeue_dead(ids); self.refresh_queue_ui()
+
+    def purge_failed(self):
+        ids = self._failed_targets("清除")
+        if ids: self.engine.purge_dead(ids); self.refresh_queue_ui()
 
     def withdraw_email(self):
         sel = self.tree_queue.selection()
         if sel:
-            eid = self.tree_queue.item(sel[0])['values'][0]
-            if str(eid) in self.pending_emails: del self.pending_emails[str(eid)]; self.refresh_queue_ui()
+            self.engine.withdraw(sel)  # 表格行的 iid 就是邮件 id
+            self.refresh_queue_ui()
 
     # =================== 关键更新：带搜索的联系人选择器 ===================
     def open_contact_picker(self):
@@ -615,32 +993,39 @@ class EmailSender:
         search_entry.pack(side=tk.LEFT, padx=5, fill=tk.X, expand=True)
         
         # 2. 列表区
-        tree = ttk.Treeview(top, columns=("n", "e", "t"), show="headings", selectmode="extended")
+        list_frame = tk.Frame(top, bg="white"); list_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        sb = ttk.Scrollbar(list_frame, orient=tk.VERTICAL, style="Vertical.TScrollbar"); sb.pack(side=tk.RIGHT, fill=tk.Y)
+        tree = ttk.Treeview(list_frame, columns=("n", "e", "t"), show="headings", selectmode="extended")
         tree.heading("n", text="姓名"); tree.column("n", width=100)
         tree.heading("e", text="邮箱"); tree.column("e", width=200)
         tree.heading("t", text="职称"); tree.column("t", width=100)
-        tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
-        
-        # 3. 数据加载与搜索逻辑
-        def load_data(query=""):
-            for i in tree.get_children(): tree.delete(i)
-            conn = sqlite3.connect(self.db_path)
-            if query:
-                sql = "SELECT name, email, title FROM contacts WHERE name LIKE ? OR email LIKE ?"
-                params = (f"%{query}%", f"%{query}%")
-                rows = conn.execute(sql, params).fetchall()
-            else:
-                rows = conn.execute("SELECT name, email, title FROM contacts").fetchall()
-            conn.close()
+        tree.pack(fill=tk.BOTH, expand=True)
+        loader = LazyTreeLoader(tree, self.db, "contacts c", "c.id", ["c.name", "c.email", "c.title"],
+                                sort_exprs={"n": "COALESCE(c.name, '')", "e": "COALESCE(c.email, '')", "t": "COALESCE(c.title, '')"},
+                                scrollbar=sb)
+        
+        # 3. 数据加载与搜索逻辑 (边输入边搜索，结果分页)
+        more_btn = tk.Button(top, text="加载更多", relief="flat", bg="white", fg=ModernTheme.COLORS["primary"])
+        shown = [0]
+        def show(rows, offset, has_more):
+            if offset == 0: tree.delete(*tree.get_children())
             for r in rows: tree.insert("", tk.END, values=r)
-
-        load_data() # 初始加载
+            shown[0] = offset + len(rows)
+            if has_more: more_btn.pack(after=list_frame, pady=2)
+            else: more_btn.pack_forget()
+        def show_all():
+            more_btn.pack_forget(); loader.reset()
+        def show_results(rows, offset, has_more):
+            if offset == 0: loader.suspend()
+            show(rows, offset, has_more)
+        search = DebouncedSearch(search_entry, self.db, show_results, fields="c.name, c.email, c.title", on_empty=show_all)
+        more_btn.configure(command=lambda: search.run(shown[0]))
+        search.run() # 初始加载
         
         # 绑定搜索事件
-        search_btn = tk.Button(search_frame, text="搜索", command=lambda: load_data(search_entry.get()), 
+        search_btn = tk.Button(search_frame, text="搜索", command=search.run, 
                              bg=ModernTheme.COLORS["primary"], fg="white", relief="flat")
         search_btn.pack(side=tk.LEFT, padx=5)
-        search_entry.bind("<Return>", lambda e: load_data(search_entry.get()))
 
         # 4. 底部确认按钮
         def add_selected():
@@ -695,10 +1080,7 @@ class EmailSender:
             
             if not name: return messagebox.showwarning("提示", "请输入模板名称")
             
-            conn = sqlite3.connect(self.db_path)
-            conn.execute("INSERT INTO templates (name, subject, content) VALUES (?,?,?)", (name, subj, content))
-            conn.commit()
-            conn.close()
+            self.db.add_template(name, subj, content)
             self.refresh_tmpl_tree()
             messagebox.showinfo("成功", "模板已保存")
             top.destroy()
@@ -708,10 +1090,10 @@ class EmailSender:
 
     # 辅助功能
     def refresh_contacts(self):
-        for i in self.tree_contacts.get_children(): self.tree_contacts.delete(i)
-        conn = sqlite3.connect(self.db_path)
-        for r in conn.execute("SELECT id, name, email, title, department FROM contacts"): self.tree_contacts.insert("", tk.END, values=r)
-        conn.close()
+        if self.entry_search.get().strip():
+            return self.contact_search.run()
+        self.btn_contacts_more.pack_forget()
+        self.contacts_loader.reset()
 
     def add_contact_dialog(self):
         d = tk.Toplevel(self.root); d.geometry("300x250")
@@ -719,31 +1101,62 @@ class EmailSender:
         for k in ["姓名","邮箱","职称","院系"]:
             tk.Label(d, text=k, font=ModernTheme.FONTS["body"]).pack(); e = tk.Entry(d, font=("Microsoft YaHei", 25)); e.pack(); f[k] = e
         def s():
-            conn = sqlite3.connect(self.db_path)
-            conn.execute("INSERT INTO contacts (name,email,title,department) VALUES (?,?,?,?)", 
-                        (f["姓名"].get(), f["邮箱"].get(), f["职称"].get(), f["院系"].get()))
-            conn.commit(); conn.close(); self.refresh_contacts(); d.destroy()
+            name, email = f["姓名"].get().strip(), f["邮箱"].get().strip()
+            # 与导入时的规则一致：姓名为空或邮箱无效的联系人不保存
+            if not name: return messagebox.showwarning("提示", "请填写姓名", parent=d)
+            if not valid_email(email): return messagebox.showwarning("提示", f"邮箱格式不正确: {email or '(空)'}", parent=d)
+            self.db.upsert_contacts([(name, email, f["职称"].get().strip(), f["院系"].get().strip())])
+            self.refresh_contacts(); d.destroy()
         tk.Button(d, text="保存", command=s).pack(pady=10)
 
     def import_excel(self):
-        if not EXCEL_SUPPORT: return
-        fn = filedialog.askopenfilename()
-        if fn:
-            wb = openpyxl.load_workbook(fn); ws = wb.active
-            conn = sqlite3.connect(self.db_path)
-            for r in ws.iter_rows(min_row=2, values_only=True):
-                if r[0] and r[1]: 
-                    conn.execute("INSERT INTO contacts (name,email,title,department) VALUES (?,?,?,?)", 
-                                (r[0], r[1], r[2] if len(r)>2 else "", r[3] if len(r)>3 else ""))
-            conn.commit(); conn.close(); self.refresh_contacts()
+        """在后台线程导入 Excel/CSV，界面显示进度"""
+        types = [("CSV 文件", "*.csv")]
+        if EXCEL_SUPPORT: types.insert(0, ("Excel/CSV 文件", "*.xlsx *.xlsm *.csv"))
+        fn = filedialog.askopenfilename(filetypes=types)
+        if not fn: return
+        
+        top = tk.Toplevel(self.root); top.title("导入联系人"); top.geometry("420x140"); top.configure(bg="white")
+        top.transient(self.root)
+        lbl = tk.Label(top, text=f"正在导入 {os.path.basename(fn)} ...", bg="white", font=("Microsoft YaHei", 10))
+        lbl.pack(pady=(20, 10))
+        bar = ttk.Progressbar(top, mode="determinate", length=360); bar.pack()
+        
+        events = queue.Queue()  # 后台线程只往队列里放消息，由 Tk 主线程取出更新界面
+        def work():
+            try: events.put(("done",) + import_contacts(self.db, fn, progress=lambda done, total: events.put(("progress", done, total))))
+            except Exception as e: events.put(("error", str(e)))
+            finally: self.db.release()
+        
+        def poll():
+            try:
+                while True:
+                    ev = events.get_nowait()
+                    if ev[0] == "progress":
+                        bar.configure(maximum=max(ev[2], ev[1], 1), value=ev[1])
+                        lbl.configure(text=f"已处理 {ev[1]} 行")
+                    else:
+                        top.destroy(); self.refresh_contacts()
+                        if ev[0] == "done": messagebox.showinfo("导入完成", f"导入 {ev[1]} 位联系人 (已存在的邮箱会被更新)，跳过 {ev[2]} 行")
+                        else: messagebox.showerror("导入失败", ev[1])
+                        return
+            except queue.Empty: pass
+            top.after(100, poll)
+        
+        threading.Thread(target=work, daemon=True).start()
+        poll()
 
     def search_contacts(self):
-        q = self.entry_search.get()
-        for i in self.tree_contacts.get_children(): self.tree_contacts.delete(i)
-        conn = sqlite3.connect(self.db_path)
-        for r in conn.execute("SELECT * FROM contacts WHERE name LIKE ? OR email LIKE ?", (f"%{q}%", f"%{q}%")):
-            self.tree_contacts.insert("", tk.END, values=r)
-        conn.close()
+        self.contact_search.run()
+
+    def _show_contact_results(self, rows, offset, has_more):
+        if offset == 0:
+            self.contacts_loader.suspend()
+            self.tree_contacts.delete(*self.tree_contacts.get_children())
+        for r in rows: self.tree_contacts.insert("", tk.END, values=r)
+        self._contacts_shown = offset + len(rows)
+        if has_more: self.btn_contacts_more.pack(anchor="center", pady=5)
+        else: self.btn_contacts_more.pack_forget()
 
     def delete_contact(self):
         """删除选中的联系人"""
@@ -753,31 +1166,20 @@ class EmailSender:
             return
         
         if messagebox.askyesno("确认删除", "确定要删除选中的联系人吗？"):
-            conn = sqlite3.connect(self.db_path)
-            for item in sel:
-                cid = self.tree_contacts.item(item)['values'][0]
-                conn.execute("DELETE FROM contacts WHERE id=?", (cid,))
-            conn.commit()
-            conn.close()
+            self.db.delete_contacts([self.tree_contacts.item(item)['values'][0] for item in sel])
             self.refresh_contacts()
             messagebox.showinfo("成功", "联系人已删除")
 
     def refresh_tmpl_tree(self):
         for i in self.tree_tmpl.get_children(): self.tree_tmpl.delete(i)
-        conn = sqlite3.connect(self.db_path)
-        for r in conn.execute("SELECT id, name, subject FROM templates"): self.tree_tmpl.insert("", tk.END, values=r)
-        conn.close()
+        for r in self.db.list_templates(): self.tree_tmpl.insert("", tk.END, values=r)
     
     def refresh_tmpl_combo(self):
-        conn = sqlite3.connect(self.db_path)
-        self.combo_tmpl['values'] = [r[0] for r in conn.execute("SELECT name FROM templates")]
-        conn.close()
+        self.combo_tmpl['values'] = self.db.template_names()
 
     def on_tmpl_select(self, e):
         n = self.combo_tmpl.get()
-        conn = sqlite3.connect(self.db_path)
-        r = conn.execute("SELECT subject, content FROM templates WHERE name=?", (n,)).fetchone()
-        conn.close()
+        r = self.db.get_template(n)
         if r:
             self.entry_subject.delete(0, tk.END); self.entry_subject.insert(0, r[0])
             self.txt_content.delete("1.0", tk.END); self.txt_content.insert(tk.END, r[1])
@@ -786,9 +1188,7 @@ class EmailSender:
         sel = self.tree_tmpl.selection()
         if sel:
             tid = self.tree_tmpl.item(sel[0])['values'][0]
-            conn = sqlite3.connect(self.db_path)
-            conn.execute("DELETE FROM templates WHERE id=?", (tid,))
-            conn.commit(); conn.close(); self.refresh_tmpl_tree()
+            self.db.delete_template(tid); self.refresh_tmpl_tree()
 
     def load_template_to_editor(self, e):
         sel = self.tree_tmpl.selection()
@@ -799,18 +1199,31 @@ class EmailSender:
             self.on_tmpl_select(None)
 
     def refresh_history(self):
-        for i in self.tree_hist.get_children(): self.tree_hist.delete(i)
-        conn = sqlite3.connect(self.db_path)
-        for r in conn.execute("SELECT recipient_name, recipient_email, subject, sent_at, status FROM history ORDER BY id DESC"):
-            self.tree_hist.insert("", tk.END, values=r)
-        conn.close()
-    
+        f = {k: e.get().strip() for k, e in self.hist_filters.items()}
+        try:
+            for k in ("since", "until"):
+                if f[k]: datetime.date.fromisoformat(f[k])
+        except ValueError:
+            return messagebox.showwarning("提示", "日期格式应为 YYYY-MM-DD")
+        self.history_loader.set_filter(*history_where(status=self.combo_hist_status.get(), **f))
+        self.history_loader.reset()
+
+    def archive_history(self):
+        days = simpledialog.askinteger("归档旧记录", "把多少天以前的发送记录移入归档库？",
+                                       initialvalue=int(self.get_config("history_retention_days", 365)) or 365, minvalue=1, parent=self.root)
+        if not days: return
+        moved = self.engine.archive_history(days)
+        self.refresh_history()
+        messagebox.showinfo("归档完成", f"已归档 {moved} 条记录到 {os.path.basename(self.engine.archive_path())}")
+
     def clear_history(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.execute("DELETE FROM history"); conn.commit(); conn.close()
+        self.engine.history_writer.flush()  # 还在缓冲中的记录也一并清除
+        self.db.clear_history()
         self.refresh_history()
 
 if __name__ == "__main__":
+    # 打包成可执行文件后，渲染进程 (render_processes) 启动时会重新执行本程序，需要先交给 multiprocessing 处理
+    import multiprocessing; multiprocessing.freeze_support()
     root = tk.Tk()
     app = EmailSender(root)
     root.mainloop()